@@ -0,0 +1,73 @@
+import asyncio
+import logging
+from typing import Optional
+
+from .services import (
+    AdminService,
+    ChatService,
+    CodegenService,
+    ExtensionService,
+    IngestionService,
+    RetrievalService,
+    SupabaseClient,
+    ToolService,
+)
+from .services.embeddings import get_embedding_service
+from .services.extensions import get_extension_registry
+from .services.ingestion import close_ingestion_pool
+from .services.log_spool import close_log_spool
+from .services.logger import close_log_writer
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceContainer:
+    """Services of the API, built once at startup and shared by all requests.
+
+    The services keep no state of a request. The Supabase client they share is a
+    singleton, whose `user_id` is the user of the current request: it's kept in a
+    context variable, set when the request is authenticated and inherited by the tasks
+    and threads the request starts. Work outliving the request, such as debounced
+    chat statuses and document ingestions, records its user explicitly. Their pools and
+    caches live as long as the application, and are released by `close`.
+    """
+
+    def __init__(self, supabase: SupabaseClient):
+        self.supabase = supabase
+        self.extension_registry = get_extension_registry()
+        self.embedding_service = get_embedding_service()
+        self.codegen_service = CodegenService(supabase=supabase)
+        self.chat_service = ChatService(
+            codegen_service=self.codegen_service, supabase=supabase
+        )
+        self.tool_service = ToolService(supabase=supabase)
+        self.admin_service = AdminService(supabase=supabase)
+        self.extension_service = ExtensionService(
+            supabase=supabase, registry=self.extension_registry
+        )
+        self.ingestion_service = IngestionService(supabase=supabase)
+        self.retrieval_service = RetrievalService(
+            supabase=supabase, embeddings=self.embedding_service
+        )
+        self._resume_ingestion: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # Discover the extensions once, rather than on the first request
+        await asyncio.to_thread(self.extension_registry.refresh)
+        # Pick up document ingestions interrupted by a crash or a restart
+        self._resume_ingestion = asyncio.create_task(
+            self.ingestion_service.resume_stale_forever()
+        )
+
+    async def close(self):
+        logger.info("Application shutting down. Cleaning up resources...")
+        if self._resume_ingestion is not None:
+            self._resume_ingestion.cancel()
+        close_ingestion_pool()
+        # Write the debounced chat statuses, and the chat logs still buffered, before
+        # the client goes away
+        await self.chat_service.chat_manager.status_tracker.flush()
+        close_log_writer()
+        # Ships what's left of the spool, off the event loop
+        await asyncio.to_thread(close_log_spool)
+        SupabaseClient.reset()
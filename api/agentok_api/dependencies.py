@@ -1,16 +1,18 @@
 import logging
-from functools import lru_cache
-from pathlib import Path
 from typing import Optional
 
-from fastapi import Depends, HTTPException, Security, status
+from fastapi import Depends, HTTPException, Request, Security, status
 from fastapi.security import APIKeyHeader, HTTPAuthorizationCredentials, HTTPBearer
 
+from .container import ServiceContainer
 from .services import (
     AdminService,
     ChatService,
     CodegenService,
+    EmbeddingService,
     ExtensionService,
+    IngestionService,
+    RetrievalService,
     SupabaseClient,
     ToolService,
 )
@@ -21,11 +23,17 @@ api_key_scheme = APIKeyHeader(name="X-API-Key", auto_error=False)
 security_scheme = HTTPBearer(auto_error=False)
 
 
+def get_services(request: Request) -> ServiceContainer:
+    # Built by the lifespan of the application, see main.py
+    return request.app.state.services
+
+
 async def get_supabase_client(
     api_key: Optional[str] = Security(api_key_scheme),
     credentials: Optional[HTTPAuthorizationCredentials] = Security(security_scheme),
+    services: ServiceContainer = Depends(get_services),
 ) -> SupabaseClient:
-    supabase = SupabaseClient()
+    supabase = services.supabase
     logger.debug("Attempting to authenticate user")
     if api_key:
         logger.debug("API key provided")
@@ -60,52 +68,62 @@ async def get_supabase_client(
         )
 
 
+# The services are shared, the dependencies below only require the request to be
+# authenticated, which sets the user of the Supabase client for this request
+
+
 def get_extension_service(
     supabase: SupabaseClient = Depends(get_supabase_client),
+    services: ServiceContainer = Depends(get_services),
 ) -> ExtensionService:
-    extensions_path = Path(__file__).parent / "extensions"
-    return ExtensionService(
-        supabase=supabase, extensions_path=extensions_path.as_posix()
-    )
+    return services.extension_service
 
 
 def get_tool_service(
     supabase: SupabaseClient = Depends(get_supabase_client),
-) -> ExtensionService:
-    return ToolService(supabase=supabase)
+    services: ServiceContainer = Depends(get_services),
+) -> ToolService:
+    return services.tool_service
 
 
-def get_codegen_service(
+def get_embedding_service(
     supabase: SupabaseClient = Depends(get_supabase_client),
-) -> CodegenService:
-    return CodegenService(supabase=supabase)
+    services: ServiceContainer = Depends(get_services),
+) -> EmbeddingService:
+    # Shared by all requests, so concurrent queries are batched together
+    return services.embedding_service
 
 
-# Using @lru_cache() effectively makes get_chat_service a singleton provider, as it caches the result of the first call and returns it for subsequent calls.
-@lru_cache()
-def create_chat_service(
-    codegen_service: CodegenService, supabase: SupabaseClient
-) -> ChatService:
-    print("Creating ChatService singleton")
-    return ChatService(codegen_service=codegen_service, supabase=supabase)
+def get_ingestion_service(
+    supabase: SupabaseClient = Depends(get_supabase_client),
+    services: ServiceContainer = Depends(get_services),
+) -> IngestionService:
+    return services.ingestion_service
+
+
+def get_retrieval_service(
+    supabase: SupabaseClient = Depends(get_supabase_client),
+    services: ServiceContainer = Depends(get_services),
+) -> RetrievalService:
+    return services.retrieval_service
 
 
-# Global variable to hold the singleton
-chat_service_singleton = None
+def get_codegen_service(
+    supabase: SupabaseClient = Depends(get_supabase_client),
+    services: ServiceContainer = Depends(get_services),
+) -> CodegenService:
+    return services.codegen_service
 
 
 def get_chat_service(
-    codegen_service: CodegenService = Depends(get_codegen_service),
     supabase: SupabaseClient = Depends(get_supabase_client),
+    services: ServiceContainer = Depends(get_services),
 ) -> ChatService:
-    global chat_service_singleton
-    if chat_service_singleton is None:
-        print("No global chat service singleton found. Creating...")
-        chat_service_singleton = create_chat_service(codegen_service, supabase)
-    return chat_service_singleton
+    return services.chat_service
 
 
 def get_admin_service(
     supabase: SupabaseClient = Depends(get_supabase_client),
+    services: ServiceContainer = Depends(get_services),
 ) -> AdminService:
-    return AdminService(supabase=supabase)
+    return services.admin_service
@@ -1,15 +1,16 @@
+import base64
 import os
 import re
+from typing import Dict, List, Literal, Optional, Union
+
 from autogen import ConversableAgent
 from openai import OpenAI
-from typing import Dict, Literal, Union, Optional, List
-
-from ..extended_agent import ExtendedConversableAgent
-from ...services.supabase import create_supabase_client
-from ...utils.img_utils import get_image_data, _to_pil
 from termcolor import colored
 
-from diskcache import Cache
+from ...services.supabase import create_supabase_client
+from ...utils.image_cache import get_or_create_image, image_cache_key
+from ...utils.img_utils import _to_pil
+from ..extended_agent import ExtendedConversableAgent
 
 
 def dalle_call(
@@ -36,46 +37,42 @@ def dalle_call(
         n (int): The number of images to generate.
 
     Returns:
-    str: The image data as a string, either retrieved from the cache or newly generated.
+    bytes: The raw image data, either retrieved from the cache or newly generated.
 
     Note:
-    - The cache is stored in a directory named '.cache/'.
-    - The function uses a tuple of (model, prompt, size, quality, n) as the key for caching.
-    - The image data is obtained by making a secondary request to the URL provided by the DALL-E API response.
+    - The cache is shared by the process, stored in `.cache/images/` and bounded in size, see `utils/image_cache.py`.
+    - The key is a hash of the normalized (model, prompt, size, quality, n), prompts differing only by spacing share an image.
+    - Concurrent calls with the same parameters make a single API call.
+    - The image data is requested in the DALL-E API response, as base64, rather than downloaded from a URL.
     """
-    # Create a cache directory
-    cache = Cache(".cache/")
-    key = (model, prompt, size, quality, n)
-
-    # Check if the result is in cache
-    if key in cache:
-        cached_data = cache[key]
-        if isinstance(cached_data, bytes):
-            return cached_data
-
-    # If not in cache, compute and store the result
-    response = client.images.generate(
+    key = image_cache_key(
+        "dalle",
         model=model,
         prompt=prompt,
         size=size,
         quality=quality,
         n=n,
+        response_format="b64_json",
     )
 
-    # Assuming the response contains URLs to the generated images
-    if len(response.data) == 0:
-        return None
-    image_url = response.data[0].url
-    if image_url is None:
-        return None
-
-    # Fetch the image data from the URL
-    img_data = get_image_data(image_url)
+    def generate() -> Optional[bytes]:
+        response = client.images.generate(
+            model=model,
+            prompt=prompt,
+            size=size,
+            quality=quality,
+            n=n,
+            response_format="b64_json",
+        )
 
-    # Store the result in the cache
-    cache[key] = img_data
+        if len(response.data) == 0:
+            return None
+        image_b64 = response.data[0].b64_json
+        if image_b64 is None:
+            return None
+        return base64.b64decode(image_b64)
 
-    return img_data
+    return get_or_create_image(key, generate)
 
 
 def extract_img(agent: ConversableAgent):
@@ -162,26 +159,16 @@ class DALLEAgent(ExtendedConversableAgent):
         if img_data is None:
             return False, "Failed to generate image with DALL-E"
 
-        # Generate a unique filename for the image
-        filename = f"{prompt.replace(' ', '_')}.png"
-
         # Upload the image data to Supabase or another storage service
         supabase = create_supabase_client()
         if supabase is None:
             return False, "Supabase client is not available"
-        upload_response = supabase.upload_image(filename, img_data)
-
-        if upload_response.status_code != 200:
-            print(
-                colored(
-                    f"Failed to upload image to Supabase: {upload_response.reason_phrase}",
-                    "red",
-                )
-            )
+        try:
+            image_url = supabase.upload_image(img_data)
+        except Exception as e:
+            print(colored(f"Failed to upload image to Supabase: {e}", "red"))
             return False, "Failed to upload image"
 
-        upload_result = upload_response.json()
-
         # Generate the response message with the URL of the uploaded image
-        out_message = f"![img]({upload_result['Location']})"
+        out_message = f"![img]({image_url})"
         return True, out_message
@@ -1,4 +1,5 @@
 import logging
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
@@ -7,11 +8,14 @@ from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
+from .container import ServiceContainer
 from .routers import (
     admin,
     api_docs,
     chats,
     codegen,
+    datasets,
+    documents,
     extension,
     tools,
 )
@@ -39,10 +43,25 @@ main_app.add_middleware(
 main_app.include_router(chats.router, prefix="/chats", tags=["Chat"])
 main_app.include_router(tools.router, prefix="/tools", tags=["Tool"])
 main_app.include_router(codegen.router, prefix="/codegen", tags=["Codegen"])
+main_app.include_router(datasets.router, prefix="/datasets", tags=["Dataset"])
+main_app.include_router(documents.router, prefix="/documents", tags=["Document"])
 main_app.include_router(extension.router, prefix="/extensions", tags=["Extension"])
 main_app.include_router(admin.router, prefix="/admin", include_in_schema=False)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Mounted applications don't run a lifespan, the services are built here for both
+    services = ServiceContainer(SupabaseClient())
+    app.state.services = main_app.state.services = services
+    await services.start()
+    try:
+        yield
+    finally:
+        await services.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/v1", main_app)
 app.include_router(api_docs.router, include_in_schema=False)
 
@@ -160,10 +179,3 @@ async def root():
 
 # Mount the static directory to serve favicon file
 app.mount("/static", StaticFiles(directory="static"), name="static")
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Clean up resources when the application shuts down"""
-    logger.info("Application shutting down. Cleaning up resources...")
-    SupabaseClient.reset()
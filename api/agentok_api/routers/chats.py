@@ -1,16 +1,48 @@
-from typing import List
-from fastapi import APIRouter, Depends
+from typing import Dict, List, Literal, Optional, Union
+
+from fastapi import APIRouter, Depends, Query, Request, Response
+
+from ..dependencies import get_chat_service
 from ..models import Chat, ChatCreate, MessageCreate
 from ..services import ChatService
-from ..dependencies import get_chat_service
+from ..utils.etag import etag_response
+from ..utils.pagination import MAX_PAGE_SIZE, SORTABLE_COLUMNS, parse_fields
 
 router = APIRouter()
 
+# Upper bound of the page size when paginating messages
+MAX_MESSAGES_PER_PAGE = 1000
 
-@router.get("", summary="Get existing chats", response_model=List[Chat])
-async def get_chats(service: ChatService = Depends(get_chat_service)):
-    print("get_chats")
-    return await service.get_chats()
+
+@router.get(
+    "",
+    summary="Get existing chats",
+    description="""Chats are sorted by `sort` then id, most recent first unless `order=asc`.
+Without `limit` all the chats are returned. Otherwise, the `X-Next-Cursor` response header holds the `cursor` of the next page, and is missing on the last page.
+Only the listed `fields` are returned if set, e.g. `fields=name,status`.""",
+)
+async def get_chats(
+    response: Response,
+    cursor: Optional[str] = Query(
+        None, description="Cursor of the page, from `X-Next-Cursor`"
+    ),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    sort: Literal[SORTABLE_COLUMNS] = "updated_at",
+    order: Literal["asc", "desc"] = "desc",
+    status: Optional[List[str]] = Query(
+        None, description="Only return chats with one of these statuses"
+    ),
+    fields: Optional[str] = Query(
+        None, description="Comma-separated fields to return, `id` is always included"
+    ),
+    service: ChatService = Depends(get_chat_service),
+) -> List[Union[Chat, Dict]]:
+    chats, next_cursor = await service.get_chats(
+        cursor, limit, sort, order == "desc", status, parse_fields(fields)
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return chats
 
 
 @router.post("", response_model=Chat, summary="Create a new chat")
@@ -26,12 +58,39 @@ async def get_chat(chat_id: str, service: ChatService = Depends(get_chat_service
     return await service.get_chat(chat_id)
 
 
-@router.get("/{chat_id}/messages", summary="Get messages of one chat session")
+@router.get(
+    "/{chat_id}/messages",
+    summary="Get messages of one chat session",
+    description="""Messages are ordered by id. To only fetch what is new, pass the id of the last message received as `after_id`.
+Heavy fields such as `metadata` can be left out by listing the wanted ones in `fields`, e.g. `fields=type,content,sender`.
+Responses carry an ETag, send it back in `If-None-Match` to get `304 Not Modified` when nothing changed.""",
+)
 async def get_messages(
+    request: Request,
     chat_id: str,
+    after_id: Optional[int] = Query(
+        None, description="Only return messages added after this one"
+    ),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_MESSAGES_PER_PAGE),
+    fields: Optional[str] = Query(
+        None, description="Comma-separated fields to return, `id` is always included"
+    ),
     service: ChatService = Depends(get_chat_service),
 ):
-    return await service.get_messages(chat_id)
+    messages = await service.get_messages(
+        chat_id, after_id, limit, parse_fields(fields)
+    )
+    return etag_response(request, messages)
+
+
+@router.get(
+    "/{chat_id}/logs",
+    summary="Get logs of one chat session",
+    description="Logs which are not shipped to the database yet are read from the local spool and appended at the end.",
+    response_model=List[Dict],
+)
+async def get_logs(chat_id: str, service: ChatService = Depends(get_chat_service)):
+    return await service.get_logs(chat_id)
 
 
 @router.post("/{chat_id}/messages", summary="Start chat")
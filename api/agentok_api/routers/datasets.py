@@ -0,0 +1,33 @@
+from typing import Dict, List, Literal, Optional
+
+from fastapi import APIRouter, Depends, Query, Response
+
+from ..dependencies import get_retrieval_service
+from ..services import RetrievalService
+from ..services.retrieval import RERANKERS
+
+router = APIRouter()
+
+
+@router.get(
+    "/search",
+    summary="Search datasets",
+    description="""Returns the chunks of the datasets most relevant to the query, found by both vector and full-text search and fused by rank.
+With a `reranker`, the best chunks are then reordered by a cross-encoder or by Cohere, `AGENTOK_RERANKER` sets the default.
+`timings` holds the milliseconds spent in each stage, also sent in the `Server-Timing` header.""",
+)
+async def search_datasets(
+    response: Response,
+    query: str = Query(..., min_length=1),
+    dataset_ids: List[int] = Query(
+        ..., alias="dataset_id", description="Dataset to search, may be repeated"
+    ),
+    top_k: int = Query(5, ge=1, le=50),
+    reranker: Optional[Literal[RERANKERS]] = None,
+    service: RetrievalService = Depends(get_retrieval_service),
+) -> Dict:
+    result = await service.search(dataset_ids, query, top_k, reranker)
+    response.headers["Server-Timing"] = ", ".join(
+        f"{stage};dur={duration}" for stage, duration in result["timings"].items()
+    )
+    return result
@@ -0,0 +1,22 @@
+from typing import Dict
+
+from fastapi import APIRouter, Depends, status
+
+from ..dependencies import get_ingestion_service
+from ..services import IngestionService
+
+router = APIRouter()
+
+
+@router.post(
+    "/{document_id}/ingest",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Ingest a document",
+    description="""Chunk the document, stored in the `documents` bucket at its `path`, and store the embeddings of the chunks in its dataset.
+Ingestion runs in the background, follow it with the `status` and `chunk_count` of the document. Ingesting a document again replaces its chunks.""",
+    response_model=Dict,
+)
+async def ingest_document(
+    document_id: int, service: IngestionService = Depends(get_ingestion_service)
+):
+    return await service.ingest(document_id)
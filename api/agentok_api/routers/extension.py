@@ -1,40 +1,48 @@
-from fastapi import APIRouter, Depends, status
 from typing import List
-from ..services import ExtensionService
+
+from fastapi import APIRouter, Depends, Request, status
+
 from ..dependencies import get_extension_service
 from ..models import AgentMetadata
+from ..services import ExtensionService
+from ..utils.etag import etag_response
 
 router = APIRouter()
 
-@router.get('/agent',
-            status_code=status.HTTP_200_OK,
-            response_model=List[AgentMetadata],
-            responses={
-                status.HTTP_200_OK: {
-                    "description": "Successfully retrieved the list of extensions.",
-                    "content": {
-                        "application/json": {
-                            "example": {
-                                "extensions": [
-                                    {
-                                        "id": "dalle_agent",
-                                        "name": "DALLEAgent",
-                                        "description": "An agent that uses OpenAI's DALL-E model to generate images.",
-                                        "type": "custom_conversable",
-                                        "label": "DALLE",
-                                        "class": "DALLEAgent"
-                                    },
-                                ]
-                            }
-                        }
-                    },
-                },
-                status.HTTP_500_INTERNAL_SERVER_ERROR: {
-                    "description": "Internal server error",
-                },
+
+@router.get(
+    "/agent",
+    status_code=status.HTTP_200_OK,
+    response_model=List[AgentMetadata],
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successfully retrieved the list of extensions.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "extensions": [
+                            {
+                                "id": "dalle_agent",
+                                "name": "DALLEAgent",
+                                "description": "An agent that uses OpenAI's DALL-E model to generate images.",
+                                "type": "custom_conversable",
+                                "label": "DALLE",
+                                "class": "DALLEAgent",
+                            },
+                        ]
+                    }
+                }
             },
-            summary="Retrieve extended agents",  # Short summary for the operation
-            description="""Fetch the list of extended agents currently loaded by the service, usually subclass of ConversableAgent.""",
-            )
-async def api_get_agents(service: ExtensionService = Depends(get_extension_service)):
-    return service.load_extensions()
\ No newline at end of file
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "description": "Internal server error",
+        },
+    },
+    summary="Retrieve extended agents",  # Short summary for the operation
+    description="""Fetch the list of extended agents currently loaded by the service, usually subclass of ConversableAgent.
+The response has an `ETag`, send it back in `If-None-Match` to get a 304 if the extensions didn't change.""",
+)
+async def api_get_agents(
+    request: Request, service: ExtensionService = Depends(get_extension_service)
+):
+    return etag_response(request, service.load_extensions())
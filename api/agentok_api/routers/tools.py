@@ -1,27 +1,65 @@
-from fastapi import APIRouter, Depends
-from typing import List
+from typing import Dict, List, Literal, Optional
+
+from fastapi import APIRouter, Depends, Query, Response
+
+from ..dependencies import get_tool_service
 from ..models import Tool, ToolCreate
 from ..services import ToolService
-from ..dependencies import get_tool_service
+from ..utils.pagination import MAX_PAGE_SIZE, SORTABLE_COLUMNS, parse_fields
 
 router = APIRouter()
 
-@router.get('', summary="Get all tools", response_model=List[Tool])
-async def get_tools(service: ToolService = Depends(get_tool_service)):
-    return await service.get_tools()
 
-@router.post('', summary="Create a new tool", response_model=Tool)
-async def create_tool(tool: ToolCreate, service: ToolService = Depends(get_tool_service)):
+@router.get(
+    "",
+    summary="Get all tools",
+    description="""Returns the tools of the user and the public ones, sorted by `sort` then id, most recent first unless `order=asc`.
+Without `limit` all the tools are returned. Otherwise, the `X-Next-Cursor` response header holds the `cursor` of the next page, and is missing on the last page.
+Only the listed `fields` are returned if set, e.g. `fields=name,description`.""",
+)
+async def get_tools(
+    response: Response,
+    cursor: Optional[str] = Query(
+        None, description="Cursor of the page, from `X-Next-Cursor`"
+    ),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    sort: Literal[SORTABLE_COLUMNS] = "updated_at",
+    order: Literal["asc", "desc"] = "desc",
+    is_public: Optional[bool] = Query(
+        None, description="Only return public tools if true, only private ones if false"
+    ),
+    fields: Optional[str] = Query(
+        None, description="Comma-separated fields to return, `id` is always included"
+    ),
+    service: ToolService = Depends(get_tool_service),
+) -> List[Dict]:
+    tools, next_cursor = await service.get_tools(
+        cursor, limit, sort, order == "desc", is_public, parse_fields(fields)
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return tools
+
+
+@router.post("", summary="Create a new tool", response_model=Tool)
+async def create_tool(
+    tool: ToolCreate, service: ToolService = Depends(get_tool_service)
+):
     return await service.create_tool(tool)
 
-@router.get('/{tool_id}', summary="Get a tool", response_model=Tool)
+
+@router.get("/{tool_id}", summary="Get a tool", response_model=Tool)
 async def get_tool(tool_id: str, service: ToolService = Depends(get_tool_service)):
     return await service.get_tool(tool_id)
 
-@router.delete('/{tool_id}', summary="Delete a tool", response_model=dict)
+
+@router.delete("/{tool_id}", summary="Delete a tool", response_model=dict)
 async def delete_tool(tool_id: str, service: ToolService = Depends(get_tool_service)):
     return await service.delete_tool(tool_id)
 
-@router.put('/{tool_id}', summary="Update a tool", response_model=Tool)
-async def update_tool(tool_id: str, tool: ToolCreate, service: ToolService = Depends(get_tool_service)):
+
+@router.put("/{tool_id}", summary="Update a tool", response_model=Tool)
+async def update_tool(
+    tool_id: str, tool: ToolCreate, service: ToolService = Depends(get_tool_service)
+):
     return await service.update_tool(tool_id, tool)
@@ -1,7 +1,10 @@
 from .admin import AdminService
 from .chats import ChatService
 from .codegen import CodegenService
+from .embeddings import EmbeddingService
 from .extensions import ExtensionService
+from .ingestion import IngestionService
+from .retrieval import RetrievalService
 from .supabase import SupabaseClient
 from .tools import ToolService
 
@@ -9,7 +12,10 @@ __all__ = [
     "AdminService",
     "ChatService",
     "CodegenService",
+    "EmbeddingService",
     "ExtensionService",
+    "IngestionService",
+    "RetrievalService",
     "SupabaseClient",
     "ToolService",
 ]
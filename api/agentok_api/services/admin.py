@@ -2,14 +2,16 @@ import secrets
 from typing import Dict, List
 
 from ..models import ApiKey, ApiKeyCreate
+from ..utils.image_cache import image_cache_stats
 from .supabase import SupabaseClient
 
+
 class AdminService:
     def __init__(self, supabase: SupabaseClient):
-      self.supabase = supabase
+        self.supabase = supabase
 
     def generate_api_key(self):
-        return 'atk_' + secrets.token_urlsafe(32)
+        return "atk_" + secrets.token_urlsafe(32)
 
     def issue_apikey(self, key_to_create: ApiKeyCreate) -> ApiKey:
         key_to_create.key = self.generate_api_key()
@@ -20,3 +22,6 @@ class AdminService:
 
     def delete_apikey(self, apikey_id: str) -> Dict:
         return self.supabase.delete_apikey(apikey_id)
+
+    def get_cache_stats(self) -> Dict:
+        return {"images": image_cache_stats()}
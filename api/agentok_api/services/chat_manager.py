@@ -1,25 +1,66 @@
+import ast
 import asyncio
 import os
-from asyncio import subprocess
 import signal
-from fastapi import logger
-from termcolor import colored
+from asyncio import subprocess
+from collections import deque
 from dataclasses import dataclass
-from typing import List, Dict, Optional
-import ast
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from termcolor import colored
 
 from ..models import LogCreate
+from ..utils.importtime import is_importtime_line, summarize_importtime
+from .chat_status import ChatStatusTracker
+from .inprocess_runner import InProcessRunner
+from .log_spool import get_log_spool
+from .output_parser import OutputParser
+from .output_pipeline import OutputPipeline, sync_sink
 from .supabase import SupabaseClient
 
-from .output_parser import OutputParser
+# Number of stderr lines kept to report why an assistant failed
+STDERR_TAIL_LINES = 50
+# Longer output lines, e.g. a dumped payload, are truncated to this many bytes
+MAX_LINE_BYTES = 64 * 1024
+
+
+async def read_lines(stream: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    """Lines of a stream, truncating those over its buffer limit instead of raising."""
+    while True:
+        try:
+            yield await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            # The last line has no line break
+            if e.partial:
+                yield e.partial
+            return
+        except asyncio.LimitOverrunError as e:
+            line = await stream.read(e.consumed)
+            # Skip the rest of the line
+            while True:
+                try:
+                    await stream.readuntil(b"\n")
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError as rest:
+                    await stream.read(rest.consumed)
+            yield line[:MAX_LINE_BYTES] + b" [truncated]\n"
+
 
 class ChatManager:
     def __init__(self, supabase: SupabaseClient):
         # Private dictionary to store references to subprocesses
         self._subprocesses = {}
+        # Runs generated flows in threads of this process, for projects opting in
+        self._runner = InProcessRunner()
         self.supabase = supabase
+        # Skips redundant chat status writes and coalesces rapid transitions
+        self.status_tracker = ChatStatusTracker(supabase)
+        # Appends the output of the assistants to a local spool, shipped to chat_logs later
+        self.log_spool = get_log_spool()
 
-    async def _print_message(self, message):
+    def _print_message(self, message):
         print("New message received:", message)
 
     def strip_prefix(self, input_string, substrings):
@@ -35,18 +76,18 @@ class ChatManager:
         return input_string
 
     async def run_assistant(
-        self, chat_id: str, message: str, source_path: str, on_message=None
+        self,
+        chat_id: str,
+        message: str,
+        source_path: str,
+        on_message=None,
+        extra_env: Optional[Dict[str, str]] = None,
+        in_process: bool = False,
     ):
         # If on_message is None, fallback to default print
         if on_message is None:
             on_message = self._print_message
 
-        command = ["python3", source_path, f'{message}']
-        print(colored(text=f'Running {" ".join(command)}', color="blue"))
-
-        env = os.environ.copy()
-        env["PYTHONPATH"] = os.getcwd()
-
         # Check if there is already a subprocess for given chat_id
         if chat_id in self._subprocesses:
             print(
@@ -61,92 +102,62 @@ class ChatManager:
             # Terminate the old process
             old_process.terminate()
             await old_process.wait()
+        # The chat may also be running in process, whichever way it runs now
+        await self._runner.stop(chat_id)
 
-        self.supabase.set_chat_status(chat_id, "running")
-
-        process = await asyncio.create_subprocess_exec(
-            *command,
-            env=env,
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-
-        # Store the process and its stdin so we can use it to send input later
-        self._subprocesses[chat_id] = {"process": process, "stdin": process.stdin}
+        await self.status_tracker.set_status(chat_id, "running")
 
         output_parser = OutputParser(on_message=on_message)
 
-        # Process the subprocess output until it terminates
-        async for line in process.stdout:
-            if line:
-                response_message = line.decode().rstrip()
-                print("📺 ", response_message)
-
-                try:
-                    await self.supabase.add_log(LogCreate(
-                        message=response_message,
-                        level='info',
-                        chat_id=chat_id,
-                    ))
-                except Exception as e:
-                    logger.error(f"Failed to log message: {e}")
-
-                # Let the output parser handle the message
-                output_parser.parse_line(response_message)
-
-                # Check if we need to update chat status
-                new_status = output_parser.get_chat_status(response_message)
-                if new_status:
-                    self.supabase.set_chat_status(chat_id, new_status)
-
-        # Wait for the subprocess to finish if it hasn't already
-        await process.wait()
+        if in_process:
+            returncode, error_message = await self._run_in_process(
+                chat_id, message, source_path, output_parser, extra_env
+            )
+        else:
+            returncode, error_message = await self._run_subprocess(
+                chat_id, message, source_path, output_parser, extra_env
+            )
 
         # Cleanup happens here regardless of whether there was an error or not
         print(
             colored(text=f"Cleaning up subprocess for chat_id {chat_id}", color="green")
         )
         self._subprocesses.pop(chat_id, None)
-        self.supabase.set_chat_status(chat_id, "ready")
 
-        # Check the exit code of the subprocess to see if there were errors
-        if process.returncode == -signal.SIGTERM:
+        # Check the exit code of the assistant to see if there were errors
+        if returncode == -signal.SIGTERM:
             print(
                 colored(
-                    text=f"Assistant process {process.pid} terminated by user",
+                    text=f"Assistant for chat {chat_id} terminated by user",
                     color="yellow",
                 )
             )
-            self.supabase.set_chat_status(chat_id, "aborted")
+            await self.status_tracker.set_status(chat_id, "aborted")
             on_message(
                 {
                     "type": "assistant",
                     "content": "__STATUS_COMPLETED__ TERMINATED",
                 }
             )
-        elif process.returncode != 0:
-            self.supabase.set_chat_status(chat_id, "failed")
-            # Read the error message from stderr (optional)
-            if process.stderr is not None:
-                err = await process.stderr.read()
-                error_message = err.decode().strip()
-                print(
-                    colored(
-                        text=f"Assistant process exited with return code {process.returncode} and error message: {error_message}",
-                        color="red",
-                    )
-                )
-                # Splits the message by lines and takes the last one
-                last_line = error_message.splitlines()[-1]
-                on_message(
-                    {
-                        "type": "assistant",
-                        "content": f"__STATUS_COMPLETED__ {process.returncode}: {last_line}",
-                    }
+        elif returncode != 0:
+            await self.status_tracker.set_status(chat_id, "failed")
+            error_message = error_message.strip()
+            print(
+                colored(
+                    text=f"Assistant exited with return code {returncode} and error message: {error_message}",
+                    color="red",
                 )
+            )
+            # Splits the message by lines and takes the last one
+            last_line = error_message.splitlines()[-1] if error_message else ""
+            on_message(
+                {
+                    "type": "assistant",
+                    "content": f"__STATUS_COMPLETED__ {returncode}: {last_line}",
+                }
+            )
         else:
-            self.supabase.set_chat_status(chat_id, "completed")
+            await self.status_tracker.set_status(chat_id, "completed")
             on_message(
                 {
                     "type": "assistant",
@@ -154,7 +165,146 @@ class ChatManager:
                 }
             )
 
+    async def _run_subprocess(
+        self,
+        chat_id: str,
+        message: str,
+        source_path: str,
+        output_parser: OutputParser,
+        extra_env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        # Optionally record the startup cost of the child interpreter, written to stderr
+        profile_imports = os.environ.get("AGENTOK_PROFILE_IMPORTS", "").lower() in (
+            "1",
+            "true",
+        )
+        if profile_imports:
+            command = ["python3", "-X", "importtime", source_path, f"{message}"]
+        else:
+            command = ["python3", source_path, f"{message}"]
+        print(colored(text=f'Running {" ".join(command)}', color="blue"))
+
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.getcwd()
+        if extra_env:
+            env.update(extra_env)
+
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            env=env,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        # Store the process and its stdin so we can use it to send input later
+        self._subprocesses[chat_id] = {"process": process, "stdin": process.stdin}
+
+        # Drain stderr while the process runs, so a chatty process can't fill the pipe and block.
+        # Only the tail is kept for the failure message.
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        importtime_lines = [] if profile_imports else None
+        stderr_task = asyncio.create_task(
+            self._drain_stderr(chat_id, process.stderr, stderr_tail, importtime_lines)
+        )
+
+        # Process the subprocess output until it terminates
+        pipeline = self._create_output_pipeline(chat_id, output_parser)
+        async for line in read_lines(process.stdout):
+            await pipeline.put(line.decode(errors="replace").rstrip())
+        await pipeline.close()
+
+        # Wait for the subprocess to finish if it hasn't already
+        await process.wait()
+        try:
+            await stderr_task
+        except Exception as e:
+            # The stderr logs are incomplete, the run itself is not affected
+            print(colored(f"Failed to read stderr of chat {chat_id}: {e}", "red"))
+
+        if importtime_lines is not None:
+            await self._log_import_profile(chat_id, importtime_lines)
+
+        return process.returncode, "\n".join(stderr_tail)
+
+    async def _drain_stderr(
+        self,
+        chat_id: str,
+        stderr: asyncio.StreamReader,
+        tail: deque,
+        importtime_lines: Optional[List[str]] = None,
+    ):
+        async for line in read_lines(stderr):
+            error_message = line.decode(errors="replace").rstrip()
+            if not error_message:
+                continue
+            if importtime_lines is not None and is_importtime_line(error_message):
+                importtime_lines.append(error_message)
+                continue
+
+            tail.append(error_message)
+            await asyncio.to_thread(
+                self.log_spool.append,
+                chat_id,
+                {"chat_id": int(chat_id), "level": "error", "message": error_message},
+            )
+
+    async def _run_in_process(
+        self,
+        chat_id: str,
+        message: str,
+        source_path: str,
+        output_parser: OutputParser,
+        extra_env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        # The chat thread waits for each line to be queued, so it's throttled by the pipeline
+        pipeline = self._create_output_pipeline(chat_id, output_parser)
+        result = await self._runner.run(
+            chat_id, message, source_path, pipeline.put, extra_env=extra_env
+        )
+        await pipeline.close()
+        return result
+
+    def _create_output_pipeline(
+        self, chat_id: str, output_parser: OutputParser
+    ) -> OutputPipeline:
+        async def log_sink(line: str):
+            await asyncio.to_thread(
+                self.log_spool.append,
+                chat_id,
+                {"chat_id": int(chat_id), "level": "info", "message": line},
+            )
+
+        return OutputPipeline(
+            output_parser,
+            log_sink=log_sink,
+            message_sink=sync_sink(output_parser.on_message),
+            status_sink=lambda status: self.status_tracker.set_status(chat_id, status),
+        )
+
+    async def _log_import_profile(self, chat_id: str, stderr_lines: List[str]):
+        profile = summarize_importtime(stderr_lines)
+        print(
+            colored(
+                text=f"Assistant imports for chat {chat_id} took {profile['total_us'] / 1000:.1f} ms",
+                color="blue",
+            )
+        )
+        await self.supabase.add_log(
+            LogCreate(
+                message=f"Import time: {profile['total_us'] / 1000:.1f} ms",
+                level="info",
+                metadata={"import_time": profile},
+                chat_id=chat_id,
+            )
+        )
+
     async def send_human_input(self, chat_id: str, user_input: str):
+        if self._runner.send_human_input(chat_id, user_input):
+            print("👤", user_input)
+            await self.status_tracker.set_status(chat_id, "running")
+            return {"detail": "Input sent to assistant."}
+
         proc_info = self._subprocesses.get(chat_id)
         if not proc_info:
             return {"error": f"No assistant found with that chat ID. {chat_id}"}
@@ -164,12 +314,19 @@ class ChatManager:
             print("👤", user_input)
             proc_info["stdin"].write(user_input.encode() + b"\n")
             await proc_info["stdin"].drain()
-            self.supabase.set_chat_status(chat_id, "running")
+            await self.status_tracker.set_status(chat_id, "running")
             return {"detail": "Input sent to assistant."}
         except Exception as e:
             return {"error": str(e)}
 
     async def abort_assistant(self, chat_id: str):
+        if self._runner.abort(chat_id):
+            # Threads can't be killed, the chat stops at its next output or input
+            print(
+                colored(f"Aborting in-process assistant for chat {chat_id}...", "cyan")
+            )
+            return {"detail": f"Assistant for chat {chat_id} is being aborted."}
+
         proc_info = self._subprocesses.get(chat_id)
         if not proc_info:
             print(
@@ -182,7 +339,11 @@ class ChatManager:
 
         process = proc_info["process"]
 
-        print(colored(f"Terminating assistant {process.pid} for chat {chat_id}...", "cyan"))
+        print(
+            colored(
+                f"Terminating assistant {process.pid} for chat {chat_id}...", "cyan"
+            )
+        )
 
         try:
             # First, try to terminate gracefully
@@ -218,5 +379,9 @@ class ChatManager:
         finally:
             # Clean up the subprocess entry
             self._subprocesses.pop(chat_id, None)
-            print(colored(f"Assistant for chat {chat_id} terminated. Cleaning up.", "green"))
-            self.supabase.set_chat_status(chat_id, "ready")
+            print(
+                colored(
+                    f"Assistant for chat {chat_id} terminated. Cleaning up.", "green"
+                )
+            )
+            await self.status_tracker.set_status(chat_id, "ready")
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Literal, Optional, Tuple
+
+from .supabase import SupabaseClient
+
+logger = logging.getLogger(__name__)
+
+ChatStatus = Literal[
+    "ready", "running", "wait_for_human_input", "completed", "aborted", "failed"
+]
+
+TERMINAL_STATUSES = {"completed", "aborted", "failed"}
+
+# Non-terminal transitions arriving within this window are coalesced into one write
+STATUS_DEBOUNCE_SECONDS = 0.2
+
+# Number of chats whose last persisted status is remembered
+MAX_TRACKED_CHATS = 10000
+
+
+class ChatStatusTracker:
+    """Per-chat state machine in front of `SupabaseClient.set_chat_status`.
+
+    - A status equal to the last persisted one is dropped.
+    - Non-terminal statuses are debounced, only the latest one in the window is written.
+    - Terminal statuses are written right away, replacing any pending transition, and the
+      chat then only leaves its terminal state when it's running again.
+
+    Writes of one chat are serialized, so a debounced write can never land after the
+    terminal status.
+    """
+
+    def __init__(
+        self, supabase: SupabaseClient, debounce: float = STATUS_DEBOUNCE_SECONDS
+    ):
+        self.supabase = supabase
+        self.debounce = debounce
+        self._persisted: "OrderedDict[str, str]" = OrderedDict()
+        self._pending: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._flushers: Dict[str, asyncio.Task] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def set_status(self, chat_id: str, status: ChatStatus):
+        chat_id = str(chat_id)
+        # Written later, possibly once the request is over, so remember whose chat this is
+        user_id = self.supabase.user_id
+
+        if status in TERMINAL_STATUSES:
+            self._cancel_pending(chat_id)
+            await self._persist(chat_id, status, user_id)
+            return
+
+        if self._persisted.get(chat_id) in TERMINAL_STATUSES and status != "running":
+            # e.g. "ready" after the chat was aborted
+            self._cancel_pending(chat_id)
+            return
+
+        self._pending[chat_id] = (status, user_id)
+        if chat_id not in self._flushers:
+            self._flushers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def flush(self):
+        """Write the pending statuses right away, e.g. when the application shuts down."""
+        for flusher in self._flushers.values():
+            flusher.cancel()
+        self._flushers.clear()
+        pending, self._pending = self._pending, {}
+        await asyncio.gather(
+            *(self._persist(chat_id, *args) for chat_id, args in pending.items())
+        )
+
+    def last_status(self, chat_id: str) -> Optional[str]:
+        return self._persisted.get(str(chat_id))
+
+    def _cancel_pending(self, chat_id: str):
+        self._pending.pop(chat_id, None)
+        flusher = self._flushers.pop(chat_id, None)
+        if flusher is not None:
+            flusher.cancel()
+
+    async def _flush_later(self, chat_id: str):
+        await asyncio.sleep(self.debounce)
+        # From here on the write can't be cancelled anymore
+        self._flushers.pop(chat_id, None)
+        pending = self._pending.pop(chat_id, None)
+        if pending is not None:
+            await self._persist(chat_id, *pending)
+
+    async def _persist(self, chat_id: str, status: str, user_id: Optional[str]):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            persisted = self._persisted.get(chat_id)
+            if persisted == status:
+                return
+            # A debounced status may be written after the chat reached a terminal one
+            if persisted in TERMINAL_STATUSES and status not in TERMINAL_STATUSES | {
+                "running"
+            }:
+                return
+            try:
+                await asyncio.to_thread(
+                    self.supabase.set_chat_status, chat_id, status, user_id
+                )
+            except Exception as e:
+                logger.error(f"Failed to set status of chat {chat_id} to {status}: {e}")
+                return
+
+            self._persisted[chat_id] = status
+            self._persisted.move_to_end(chat_id)
+            if len(self._persisted) > MAX_TRACKED_CHATS:
+                forgotten, _ = self._persisted.popitem(last=False)
+                self._locks.pop(forgotten, None)
@@ -1,8 +1,10 @@
+import asyncio
 import os
 import tempfile
 from datetime import datetime
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 
+from fastapi import HTTPException, status
 from termcolor import colored
 
 from ..models import Chat, ChatCreate, Message, MessageCreate, Project
@@ -11,15 +13,65 @@ from .codegen import CodegenService
 from .supabase import SupabaseClient  # Import your SupabaseClient
 
 
+def link_summary_messages(summary: Dict, message_ids: Dict[int, List[int]]):
+    """Replace the message counts in the metadata of a summary by the ids of the messages.
+
+    `message_ids` are the ids of the messages added since the previous summary, by the
+    index of the sequential chat they were emitted in. A single chat covers all of them.
+    Sequential chats report all their results at once, each one gets the messages of its
+    index. The counts aren't used, they include messages which weren't stored, such as
+    the carryover, and nested chats interleave their messages.
+    """
+    metadata = summary.setdefault("metadata", {})
+    if "message_counts" in metadata:
+        chat_count = len(metadata.pop("message_counts"))
+        metadata["message_ids"] = [
+            message_ids.get(index, []) for index in range(chat_count)
+        ]
+    else:
+        metadata.pop("message_count", None)
+        metadata["message_ids"] = [
+            message_id
+            for index in sorted(message_ids)
+            for message_id in message_ids[index]
+        ]
+
+
+def executes_code(project: Project) -> bool:
+    """Whether an agent of the flow executes code, user nodes always get a code executor."""
+    return any(
+        node["type"] == "user"
+        or (node.get("data") or {}).get("code_execution_config")
+        or (node.get("data") or {}).get("enable_code_execution")
+        for node in project.flow.nodes
+    )
+
+
 class ChatService:
     def __init__(self, supabase: SupabaseClient, codegen_service: CodegenService):
         self.codegen_service = codegen_service  # Injecting CodegenService instance
         self.supabase = supabase  # Keep an instance of SupabaseClient
         self.chat_manager = ChatManager(supabase)  # Injecting SupabaseClient instance
 
-    async def get_chats(self) -> List[Chat]:
-        chats = self.supabase.fetch_chats()
-        return chats
+    async def get_chats(
+        self,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort: str = "updated_at",
+        desc: bool = True,
+        statuses: Optional[List[str]] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[List[Union[Chat, Dict]], Optional[str]]:
+        if fields is not None:
+            unknown = set(fields) - set(Chat.model_fields) - {"config"}
+            if unknown:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unknown chat fields: {', '.join(sorted(unknown))}",
+                )
+        return self.supabase.fetch_chats_page(
+            cursor, limit, sort, desc, statuses, fields
+        )
 
     async def get_chat(self, chat_id: str) -> Chat:
         chat = self.supabase.fetch_chat(chat_id)
@@ -30,14 +82,43 @@ class ChatService:
         new_chat = self.supabase.create_chat(chat)
         return new_chat
 
-    async def get_messages(self, chat_id: str) -> List[Message]:
-        messages = self.supabase.fetch_messages(chat_id)
+    async def get_messages(
+        self,
+        chat_id: str,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+    ) -> List[Union[Message, Dict]]:
+        if fields is not None:
+            unknown = set(fields) - set(Message.model_fields)
+            if unknown:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unknown message fields: {', '.join(sorted(unknown))}",
+                )
+        messages = self.supabase.fetch_messages(chat_id, after_id, limit, fields)
         return messages
 
+    async def get_logs(self, chat_id: str) -> List[Dict]:
+        # Raises 404 if the chat doesn't belong to the user
+        self.supabase.fetch_chat(chat_id)
+        # The latest logs may still be waiting in the local spool. It's read first, so a
+        # segment shipped in the meantime shows up twice rather than not at all.
+        unshipped = await asyncio.to_thread(
+            self.chat_manager.log_spool.read_unshipped, chat_id
+        )
+        logs = self.supabase.fetch_logs(chat_id)
+        shipped = {(log.get("created_at"), log.get("message")) for log in logs}
+        return logs + [
+            log
+            for log in unshipped
+            if (log.get("created_at"), log.get("message")) not in shipped
+        ]
+
     async def start_chat(self, message: MessageCreate, chat_id: str):
         # No matter what happnes next, persist the message to the database beforehand
         self.supabase.add_message(message, chat_id)
-        self.supabase.set_chat_status(chat_id, "running")
+        await self.chat_manager.status_tracker.set_status(chat_id, "running")
 
         target_path = os.path.join(tempfile.gettempdir(), f"agentok/{chat_id}/")
         # Create the directory if it doesn't exist
@@ -50,32 +131,53 @@ class ChatService:
         source_file = f"{source['id']}-{datetime_obj.timestamp()}.py"
         source_path = os.path.join(target_path, source_file)
 
-        # Write tool env files, which will be used in project code
+        # Build the tool variables, which are inherited by the project code
         print(colored("Generating tool envs...", "blue"))
         project = Project(**source)
         tool_dict = self.codegen_service.build_tool_dict(project)
-        tool_envs = self.codegen_service.generate_tool_envs(project, tool_dict)
-        for tool_id, env in tool_envs.items():
-            with open(
-                os.path.join(target_path, f"{tool_id}.env"),
-                "w",
-                encoding="utf-8",
-            ) as file:
-                file.write(env)
+        tool_env = self.codegen_service.generate_tool_envs(project, tool_dict)
 
         print(colored("Generating project code...", "blue"))
         project_code = self.codegen_service.generate_project(Project(**source))
         with open(source_path, "w", encoding="utf-8") as file:
             file.write(project_code)
 
+        # Ids of the messages added since the last summary. Summaries refer to them instead
+        # of storing the whole chat history a second time.
+        message_ids: Dict[int, List[int]] = {}
+
         # Launch the agent instance and intialize the chat
         def on_message(assistant_message):
-            print(colored(f"on_message: {assistant_message}", "green"))
-            self.supabase.add_message(MessageCreate(**assistant_message), chat_id)
+            # Index of the sequential chat the message was emitted in, tagged by the parser
+            chat_index = assistant_message.pop("chat_index", 0)
+            is_summary = assistant_message.get("type") == "summary"
+            if is_summary:
+                link_summary_messages(assistant_message, message_ids)
+                message_ids.clear()
+            added = self.supabase.add_message(
+                MessageCreate(**assistant_message), chat_id
+            )
+            # Status notices have no sender and are not part of the conversation
+            if not is_summary and assistant_message.get("sender"):
+                message_ids.setdefault(chat_index, []).append(added.id)
+
+        # Trusted projects can opt in to run inside the API process, skipping the interpreter startup
+        in_process = (project.settings or {}).get("execution_mode") == "in_process"
+        if in_process and executes_code(project):
+            # The executed code would run with the privileges and the working directory of the API
+            print(
+                colored("The flow executes code, running it in a subprocess", "yellow")
+            )
+            in_process = False
 
         # When it's time to run the assistant:
         return await self.chat_manager.run_assistant(
-            chat_id, message.content or "\n", source_path, on_message
+            chat_id,
+            message.content or "\n",
+            source_path,
+            on_message,
+            extra_env=tool_env,
+            in_process=in_process,
         )
 
     async def abort_chat(self, chat_id: str):
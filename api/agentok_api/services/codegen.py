@@ -1,11 +1,12 @@
 import ast
+import hashlib
 import json
 import os
 import re
 import textwrap
 from datetime import datetime
-import hashlib
 from pathlib import Path
+from typing import Dict
 
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from jinja2.ext import do
@@ -13,8 +14,15 @@ from openai import APIStatusError, OpenAI
 from termcolor import colored
 
 from ..models import Project, Tool
+from .extensions import get_extension_registry
 from .supabase import SupabaseClient, create_supabase_client
 
+# Tool variables are passed to the generated program as AGENTOK_TOOL_<tool id>_<name>
+TOOL_ENV_PREFIX = "AGENTOK_TOOL_"
+
+# Part of the cache key of the generated code, bump it when the code generation changes
+CODEGEN_VERSION = 1
+
 
 class CodegenService:
     def __init__(self, supabase: SupabaseClient):
@@ -26,6 +34,8 @@ class CodegenService:
             extensions=[do],
         )
         self.supabase = supabase  # Keep an instance of SupabaseClient
+        self._templates_signature = None
+        self._templates_hash = ""
         self.cache_dir = Path(os.getcwd()) / ".cache" / "codegen"
         self.cache_dir.mkdir(parents=True, exist_ok=True)
 
@@ -35,8 +45,34 @@ class CodegenService:
             "id": project.id,
             "flow": project.flow.dict(),
             "updated_at": project.updated_at,
+            # Generated code imports the extensions from where they are now
+            "extensions": get_extension_registry().get_imports(),
+            "codegen_version": CODEGEN_VERSION,
+            "templates": self._get_templates_hash(),
         }
-        return hashlib.sha256(json.dumps(project_data, sort_keys=True).encode()).hexdigest()
+        return hashlib.sha256(
+            json.dumps(project_data, sort_keys=True).encode()
+        ).hexdigest()
+
+    def _get_templates_hash(self) -> str:
+        """Hash of the template sources, read again only when a template file changes."""
+        paths = sorted(
+            path
+            for searchpath in self.env.loader.searchpath
+            for path in Path(searchpath).rglob("*.j2")
+        )
+        signature = [
+            (path.as_posix(), path.stat().st_mtime_ns, path.stat().st_size)
+            for path in paths
+        ]
+        if signature != self._templates_signature:
+            digest = hashlib.sha256()
+            for path in paths:
+                digest.update(path.as_posix().encode())
+                digest.update(path.read_bytes())
+            self._templates_hash = digest.hexdigest()
+            self._templates_signature = signature
+        return self._templates_hash
 
     def _get_cached_code(self, cache_key: str) -> str | None:
         """Get cached code if it exists."""
@@ -94,7 +130,9 @@ class CodegenService:
             node for node in flow.nodes if node["type"] == "conversable"
         ]
         ASSISTANT_NODE_TYPES = ["assistant", "captain"]
-        assistant_nodes = [node for node in flow.nodes if node["type"] in ASSISTANT_NODE_TYPES]
+        assistant_nodes = [
+            node for node in flow.nodes if node["type"] in ASSISTANT_NODE_TYPES
+        ]
         print("assistant_nodes", assistant_nodes)
         gpt_assistant_nodes = [
             node for node in flow.nodes if node["type"] == "gpt_assistant"
@@ -133,9 +171,12 @@ class CodegenService:
                         ],
                         "preceding_node": next(
                             (
-                                n for n in flow.nodes
-                                if any(e["source"] == n["id"] and e["target"] == node["id"] 
-                                      for e in flow.edges)
+                                n
+                                for n in flow.nodes
+                                if any(
+                                    e["source"] == n["id"] and e["target"] == node["id"]
+                                    for e in flow.edges
+                                )
                             ),
                             None,
                         ),
@@ -165,13 +206,13 @@ class CodegenService:
             for tool_id, tool in tool_dict.items()
             if tool_id in tool_assignments
         }
-        
-        # Generate tool envs and replace placeholders
-        self.generate_tool_envs(project, tool_dict)
-        
+
+        # Resolve the function names used to register the tools
+        self.assign_tool_func_names(tool_dict)
+
         # Replace env placeholders in tool code
         for tool_id, tool in tool_dict.items():
-            tool['code'] = self.replace_env_placeholders(tool)
+            tool["code"] = self.replace_env_placeholders(tool)
 
         code = template.render(
             project=project,
@@ -191,6 +232,7 @@ class CodegenService:
             note_nodes=note_nodes,
             tool_dict=tool_dict,
             tool_assignments=tool_assignments,
+            extension_imports=get_extension_registry().get_imports(),
         )
 
         # Cache the generated code
@@ -298,18 +340,23 @@ class CodegenService:
 
         return rag_assignments
 
-    def generate_tool_envs(self, project: Project, tool_dict: dict):
-        """Generate tool environment files for the provided project.
+    def assign_tool_func_names(self, tool_dict: dict):
+        for tool in tool_dict.values():
+            meta = self.extract_tool_meta(tool["code"])
+            tool_dict[tool["id"]]["func_name"] = meta["func_name"]
+
+    def generate_tool_envs(self, project: Project, tool_dict: dict) -> Dict[str, str]:
+        """Generate the environment block holding the tool variables of the provided project.
+
+        The variables of all tools are merged into one block, prefixed with
+        `AGENTOK_TOOL_<tool id>_`, which is inherited by the generated program.
 
         Args:
             project (Project): The project metadata.
 
         Returns:
-            dict: A dictionary containing the tool IDs as keys and the environment file contents as values.
+            dict: The environment variables to pass to the generated program.
         """
-        for tool in tool_dict.values():
-            meta = self.extract_tool_meta(tool["code"])
-            tool_dict[tool["id"]]["func_name"] = meta["func_name"]
         tool_assignments = self.generate_tool_assignments(project.flow.edges, tool_dict)
 
         tool_settings = self.supabase.fetch_tool_settings()
@@ -321,14 +368,14 @@ class CodegenService:
             if int(tool_id) in tool_assignments
         }
 
-        template = self.env.get_template("tool_env.j2")
-        tool_envs = {}
-        for tool_id, tool_settings in tool_settings.items():
-            tool_envs[tool_id] = template.render(tool_settings=tool_settings)
-
-        print("tool_envs", tool_envs)
+        tool_env = {}
+        for tool_id, settings in tool_settings.items():
+            for name, value in (settings.get("variables") or {}).items():
+                tool_env[f"{TOOL_ENV_PREFIX}{tool_id}_{name}"] = (
+                    "" if value is None else str(value)
+                )
 
-        return tool_envs
+        return tool_env
 
     def replace_env_placeholders(self, tool):
         """
@@ -367,7 +414,8 @@ Retrieves relevant information and generates a response based on the query.
 Available datasets:
 {datasets_info}
 
-Choose the appropriate dataset ID based on the query.
+Choose the appropriate dataset IDs based on the query. Several datasets can be searched
+at once, pass all the relevant IDs rather than searching them one by one.
 """
 
         return dataset_prompt
@@ -527,14 +575,16 @@ if __name__ == "__main__":
     # generated_code = service.tool2py(tool_data)
     # print(generated_code)
     # Example usage
-    code = textwrap.dedent("""
+    code = textwrap.dedent(
+        """
     def hello(message: str) -> None:
         '''Send hello world message.
         Parameters:
         message (str): The message to be printed.
         '''
         print(message + '{{VAR1}}' + '{{VAR2}}')
-    """)
+    """
+    )
 
     meta_info = service.extract_tool_meta(code)
     print(json.dumps(meta_info, indent=2))
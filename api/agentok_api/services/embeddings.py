@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union
+
+from termcolor import colored
+
+from .supabase import SupabaseClient, create_supabase_client
+
+# Must produce vectors of the dimension of chunks.embedding (384)
+EMBEDDING_MODEL = (
+    os.environ.get("AGENTOK_EMBEDDING_MODEL")
+    or "sentence-transformers/all-MiniLM-L6-v2"
+)
+# Texts encoded in one call at most
+MAX_BATCH_SIZE = 64
+# Seconds to wait for concurrent requests to join a batch
+BATCH_WINDOW = 0.005
+# Number of query embeddings kept in memory
+EMBEDDING_CACHE_SIZE = 4096
+
+
+class EmbeddingService:
+    """Computes text embeddings in process with sentence-transformers.
+
+    Concurrent requests are gathered for a few milliseconds and encoded in one batch, which
+    costs about as much as encoding a single text. Embeddings are cached in an LRU keyed by
+    model and text hash, and identical texts being encoded are only encoded once. The model
+    is loaded on first use, so the dependency is only needed when embeddings are.
+    """
+
+    def __init__(
+        self,
+        supabase: SupabaseClient,
+        model_name: str = EMBEDDING_MODEL,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        batch_window: float = BATCH_WINDOW,
+        cache_size: int = EMBEDDING_CACHE_SIZE,
+    ):
+        self.supabase = supabase
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.cache_size = cache_size
+
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        # Texts waiting for the next batch, and the futures of the texts being encoded
+        self._pending: List[Tuple[Tuple[str, str], str]] = []
+        self._in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._flusher: Optional[asyncio.TimerHandle] = None
+
+    async def embed(self, text: str) -> List[float]:
+        key = (self.model_name, hashlib.sha256(text.encode("utf-8")).hexdigest())
+        embedding = self._cache.get(key)
+        if embedding is not None:
+            self._cache.move_to_end(key)
+            return embedding
+
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._in_flight[key] = loop.create_future()
+            self._pending.append((key, text))
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._flusher is None:
+                self._flusher = loop.call_later(self.batch_window, self._flush)
+        # Shielded, so a cancelled request doesn't fail the others waiting for the same text
+        return await asyncio.shield(future)
+
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*(self.embed(text) for text in texts)))
+
+    async def search_text(
+        self, dataset_id: Union[int, List[int]], text: str, top_k: int = 5
+    ) -> List[Dict]:
+        """Search the chunks most similar to a text, in one dataset or in a list of them."""
+        query_vector = await self.embed(text)
+        if isinstance(dataset_id, list):
+            return await asyncio.to_thread(
+                self.supabase.search_chunks_multi, dataset_id, query_vector, top_k
+            )
+        return await asyncio.to_thread(
+            self.supabase.search_chunks, dataset_id, query_vector, top_k
+        )
+
+    def _flush(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        batch, self._pending = (
+            self._pending[: self.max_batch_size],
+            self._pending[self.max_batch_size :],
+        )
+        if self._pending:
+            self._flusher = asyncio.get_running_loop().call_soon(self._flush)
+        if batch:
+            asyncio.create_task(self._encode_batch(batch))
+
+    async def _encode_batch(self, batch: List[Tuple[Tuple[str, str], str]]):
+        try:
+            embeddings = await asyncio.to_thread(
+                self._encode, [text for _, text in batch]
+            )
+        except Exception as e:
+            for key, _ in batch:
+                self._in_flight.pop(key).set_exception(e)
+            return
+
+        for (key, _), embedding in zip(batch, embeddings):
+            self._cache[key] = embedding
+            self._in_flight.pop(key).set_result(embedding)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        return (
+            self._get_model()
+            .encode(texts, batch_size=len(texts), normalize_embeddings=True)
+            .tolist()
+        )
+
+    def _get_model(self):
+        with self._model_lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                print(colored(f"Loading embedding model {self.model_name}", "blue"))
+                self._model = SentenceTransformer(self.model_name)
+            return self._model
+
+
+_embedding_service: Optional[EmbeddingService] = None
+
+
+def get_embedding_service() -> EmbeddingService:
+    """Return the embedding service shared by the whole process, along with its cache."""
+    global _embedding_service
+    if _embedding_service is None:
+        _embedding_service = EmbeddingService(create_supabase_client())
+    return _embedding_service
@@ -1,26 +1,188 @@
-import pkgutil
-import importlib
+import ast
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from ..extensions import ExtendedConversableAgent
+from termcolor import colored
+
+from ..models import AgentMetadata
 from .supabase import SupabaseClient
 
-class ExtensionService:
-    def __init__(self, supabase: SupabaseClient, extensions_path: str):
+EXTENSIONS_PATH = (Path(__file__).parent.parent / "extensions").as_posix()
+EXTENSIONS_PACKAGE = "agentok_api.extensions"
+EXTENSION_BASE_CLASS = "ExtendedConversableAgent"
+
+# Seconds between two checks of the extension files for changes
+CHECK_INTERVAL = 2.0
+
+
+def _base_names(node: ast.ClassDef) -> List[str]:
+    names = []
+    for base in node.bases:
+        if isinstance(base, ast.Name):
+            names.append(base.id)
+        elif isinstance(base, ast.Attribute):
+            names.append(base.attr)
+    return names
+
+
+def _class_metadata(node: ast.ClassDef) -> Optional[Dict]:
+    for statement in node.body:
+        if isinstance(statement, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "metadata"
+            for target in statement.targets
+        ):
+            try:
+                return ast.literal_eval(statement.value)
+            except ValueError:
+                return None
+    return None
+
+
+def read_module_classes(path: str) -> List[Dict]:
+    """Classes defined in a module, with their bases and literal `metadata`, without importing it."""
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), filename=path)
+    return [
+        {
+            "class_name": node.name,
+            "bases": _base_names(node),
+            "metadata": _class_metadata(node),
+        }
+        for node in tree.body
+        if isinstance(node, ast.ClassDef)
+    ]
+
+
+class ExtensionRegistry:
+    """Extended agents found in the extensions package, with their metadata.
+
+    The extension files, in the package and its subpackages, are parsed rather than imported,
+    so listing extensions doesn't load their dependencies. An extension is a class deriving
+    from ExtendedConversableAgent, directly or not, with a literal `metadata` dict.
+
+    Extensions are served from memory. The modification times of the files are checked every
+    few seconds, and the changed ones are parsed again.
+    """
+
+    def __init__(
+        self, extensions_path: str = EXTENSIONS_PATH, package: str = EXTENSIONS_PACKAGE
+    ):
         self.extensions_path = extensions_path
+        self.package = package
+        self._lock = threading.Lock()
+        self._signature: Optional[Dict[str, Tuple[int, int]]] = None
+        self._checked_at = 0.0
+        # Classes of each file, kept until the file changes
+        self._classes: Dict[str, List[Dict]] = {}
+        self._extensions: List[Dict] = []
+
+    def get_extensions(self) -> List[Dict]:
+        """Extensions as `{"module", "class_name", "metadata"}`, found again if their files changed."""
+        if time.monotonic() - self._checked_at >= CHECK_INTERVAL:
+            self.refresh()
+        return self._extensions
+
+    def get_metadata(self) -> List[Dict]:
+        return [extension["metadata"] for extension in self.get_extensions()]
+
+    def get_imports(self) -> Dict[str, str]:
+        """Import statement of each extension, by the class name used in flows."""
+        imports = {}
+        for extension in self.get_extensions():
+            name = extension["metadata"].get("class_name") or extension["class_name"]
+            statement = f"from {extension['module']} import {extension['class_name']}"
+            if name != extension["class_name"]:
+                statement += f" as {name}"
+            imports[name] = statement
+        return imports
+
+    def refresh(self, force: bool = False):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            signature = self._scan()
+            if signature == self._signature and not force:
+                return
+            previous = self._signature or {}
+            for path in signature:
+                if force or previous.get(path) != signature[path]:
+                    try:
+                        self._classes[path] = read_module_classes(path)
+                    except (OSError, SyntaxError, ValueError) as e:
+                        print(colored(f"Failed to read extension {path}: {e}", "red"))
+                        self._classes[path] = []
+            for path in set(self._classes) - set(signature):
+                del self._classes[path]
+            self._extensions = self._collect()
+            self._signature = signature
+            print(colored(f"Discovered {len(self._extensions)} extensions", "blue"))
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        signature = {}
+        for directory, _, files in os.walk(self.extensions_path):
+            for file in files:
+                if file.endswith(".py"):
+                    path = os.path.join(directory, file)
+                    stat = os.stat(path)
+                    signature[path] = (stat.st_mtime_ns, stat.st_size)
+        return signature
+
+    def _module_name(self, path: str) -> str:
+        parts = list(Path(path).relative_to(self.extensions_path).with_suffix("").parts)
+        if parts[-1] == "__init__":
+            parts.pop()
+        return ".".join([self.package, *parts])
+
+    def _collect(self) -> List[Dict]:
+        classes = [
+            {**cls, "module": self._module_name(path)}
+            for path, module_classes in sorted(self._classes.items())
+            for cls in module_classes
+        ]
+        # Classes deriving from an extension are extensions too, whichever the file
+        agent_classes = {EXTENSION_BASE_CLASS}
+        while True:
+            found = {
+                cls["class_name"]
+                for cls in classes
+                if agent_classes.intersection(cls["bases"])
+            } | {EXTENSION_BASE_CLASS}
+            if found == agent_classes:
+                break
+            agent_classes = found
+        return [
+            {
+                "module": cls["module"],
+                "class_name": cls["class_name"],
+                "metadata": cls["metadata"],
+            }
+            for cls in classes
+            if cls["class_name"] != EXTENSION_BASE_CLASS
+            and cls["class_name"] in agent_classes
+            and isinstance(cls["metadata"], dict)
+        ]
+
+
+_registry: Optional[ExtensionRegistry] = None
+
+
+def get_extension_registry() -> ExtensionRegistry:
+    global _registry
+    if _registry is None:
+        _registry = ExtensionRegistry()
+    return _registry
+
+
+class ExtensionService:
+    def __init__(self, supabase: SupabaseClient, registry: ExtensionRegistry):
         self.supabase = supabase
+        self.registry = registry
 
-    def load_extensions(self):
-        extensions_metadata = []
-        for _, name, _ in pkgutil.iter_modules([self.extensions_path]):
-            module = importlib.import_module(f".{name}", "agentok_api.extensions")
-            for attribute_name in dir(module):
-                attribute = getattr(module, attribute_name)
-                if isinstance(attribute, type) and issubclass(
-                    attribute, ExtendedConversableAgent
-                ):
-                    # Ensure the attribute is not the base class itself
-                    if attribute is not ExtendedConversableAgent:
-                        # Collect the metadata instead of instantiating the class
-                        if hasattr(attribute, "metadata"):
-                            extensions_metadata.append(attribute.metadata)
-        return extensions_metadata
+    def load_extensions(self) -> List[Dict]:
+        # Only the fields of AgentMetadata, as the endpoint serializes the response itself
+        return [
+            AgentMetadata(**metadata).model_dump()
+            for metadata in self.registry.get_metadata()
+        ]
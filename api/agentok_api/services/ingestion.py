@@ -0,0 +1,356 @@
+import asyncio
+import codecs
+import hashlib
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from termcolor import colored
+
+from ..utils.embedding_worker import embed_texts
+from .embeddings import EMBEDDING_MODEL
+from .supabase import SupabaseClient
+
+# Characters per chunk, chunks are cut at paragraph or sentence boundaries when possible
+CHUNK_SIZE = 1000
+# Characters repeated at the start of the next chunk, so context isn't lost at the cut
+CHUNK_OVERLAP = 200
+# Bytes decoded at once when streaming a document through the chunker
+READ_SIZE = 64 * 1024
+# Texts sent to a worker process in one call
+EMBED_BATCH_SIZE = 128
+# Batches being embedded at once, bounds the memory used by a large document
+EMBED_IN_FLIGHT = 4
+# Chunks written in one request
+INSERT_BATCH_SIZE = 500
+# Documents processing without progress for this long were left behind by a crash
+STALE_AFTER = timedelta(minutes=5)
+# Worker processes computing embeddings
+INGEST_WORKERS = int(os.environ.get("AGENTOK_INGEST_WORKERS") or 2)
+
+TEXT_MIME_TYPES = {"application/json", "application/xml", "application/x-ndjson"}
+
+
+def iter_text(data: bytes, read_size: int = READ_SIZE) -> Iterator[str]:
+    """Decode a document piece by piece, without holding the whole text in memory."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    view = memoryview(data)
+    for start in range(0, len(view), read_size):
+        text = decoder.decode(view[start : start + read_size])
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _find_cut(text: str, chunk_size: int) -> int:
+    # Prefer the end of a paragraph, then of a sentence or line, then of a word
+    window = text[: chunk_size + 1]
+    for separator in ("\n\n", ". ", "\n", " "):
+        cut = window.rfind(separator, chunk_size // 2)
+        if cut != -1:
+            return cut + len(separator)
+    return chunk_size
+
+
+def iter_chunks(
+    pieces: Iterable[str], chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP
+) -> Iterator[str]:
+    """Split streamed text into overlapping chunks.
+
+    The output only depends on the text, not on how it's split into pieces, so a document
+    ingested again yields the same chunks with the same indexes.
+    """
+    buffer = ""
+    # Length of the start of the buffer already part of the previous chunk
+    carried = 0
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) > chunk_size:
+            cut = _find_cut(buffer, chunk_size)
+            chunk = buffer[:cut].strip()
+            if chunk:
+                yield chunk
+            start = max(cut - overlap, 0)
+            # Start the overlap at a word boundary
+            space = buffer.find(" ", start, cut)
+            start = space + 1 if space != -1 else start
+            buffer, carried = buffer[start:], cut - start
+    if len(buffer) > carried and buffer.strip():
+        yield buffer.strip()
+
+
+def iter_batches(
+    chunks: Iterable[str], batch_size: int = EMBED_BATCH_SIZE
+) -> Iterator[List[Tuple[int, str]]]:
+    """Group chunks by batch along with their index."""
+    batch = []
+    for index, chunk in enumerate(chunks):
+        batch.append((index, chunk))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def content_hash(content: str) -> str:
+    # Same as encode(sha256(convert_to(content, 'UTF8')), 'hex') in Postgres
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ChunkIndex:
+    """Existing chunks of a document by content hash, to reuse the unchanged ones.
+
+    Each existing chunk is reused at most once. A chunk which kept its index is preferred,
+    then an enabled one, so duplicated content doesn't move chunks around needlessly.
+    """
+
+    def __init__(self, chunks: Iterable[Dict]):
+        self._by_hash: Dict[str, List[Dict]] = {}
+        for chunk in sorted(chunks, key=lambda c: not c["enabled"]):
+            self._by_hash.setdefault(chunk["content_hash"], []).append(chunk)
+
+    def take(self, digest: str, index: int) -> Optional[Dict]:
+        candidates = self._by_hash.get(digest)
+        if not candidates:
+            return None
+        position = next(
+            (i for i, c in enumerate(candidates) if c["chunk_index"] == index), 0
+        )
+        return candidates.pop(position)
+
+    def leftover_ids(self) -> List[int]:
+        """Enabled chunks which weren't reused, their content left the document."""
+        return [
+            chunk["id"]
+            for candidates in self._by_hash.values()
+            for chunk in candidates
+            if chunk["enabled"]
+        ]
+
+
+def _is_text(data: bytes) -> bool:
+    head = data[:2048]
+    try:
+        # Needs the libmagic system library
+        import magic
+    except ImportError:
+        # Text documents are expected to be UTF-8, the head may end mid-character
+        if b"\x00" in head:
+            return False
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        except UnicodeDecodeError:
+            return False
+        return True
+    mime_type = magic.from_buffer(head, mime=True)
+    return mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Forking a process running threads is unsafe, the workers start from scratch
+        _pool = ProcessPoolExecutor(
+            max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+def close_ingestion_pool():
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class IngestionService:
+    """Chunks documents stored in the `documents` bucket and stores their embeddings.
+
+    The document is streamed through the chunker, chunks are embedded in batches on a pool
+    of worker processes, and written to `chunks` in bulk. `documents.status` goes from
+    `processing` to `ready` or `failed`, and `chunk_count` counts the chunks done so far.
+
+    Chunks carry the hash of their content. Ingesting a document again only embeds the chunks
+    whose content is new, the unchanged ones are moved to their new index and the ones no
+    longer in the document are disabled, so the cost follows the size of the edit. This also
+    makes an interrupted ingestion cheap to resume, the chunks it stored are reused. Documents
+    left in `processing` by a crash are picked up again by `resume_stale`.
+    """
+
+    # Ingestions running in this process, by document id
+    _running: Dict[int, asyncio.Task] = {}
+
+    def __init__(self, supabase: SupabaseClient, model_name: str = EMBEDDING_MODEL):
+        self.supabase = supabase
+        self.model_name = model_name
+
+    async def ingest(self, document_id: int) -> Dict:
+        """Start ingesting a document of the user, in the background."""
+        document = self.supabase.fetch_document(document_id)
+        # A document already processing is left alone, or to resume_stale if it's stuck
+        if document["status"] != "processing" and await asyncio.to_thread(
+            self.supabase.claim_document,
+            document_id,
+            document["status"],
+            values={"chunk_count": 0},
+        ):
+            self._start(document)
+        return {"document_id": document_id, "status": "processing"}
+
+    async def resume_stale(self):
+        """Resume the documents whose ingestion was interrupted."""
+        stale_before = (datetime.now(timezone.utc) - STALE_AFTER).isoformat()
+        documents = await asyncio.to_thread(
+            self.supabase.fetch_documents_by_status, "processing"
+        )
+        for document in documents:
+            if document["id"] in self._running:
+                continue
+            # Only one worker wins the claim, the others leave the document alone
+            if await asyncio.to_thread(
+                self.supabase.claim_document, document["id"], "processing", stale_before
+            ):
+                print(
+                    colored(
+                        f"Resuming ingestion of document {document['id']}", "yellow"
+                    )
+                )
+                self._start(document)
+
+    async def resume_stale_forever(self, interval: float = STALE_AFTER.total_seconds()):
+        while True:
+            try:
+                await self.resume_stale()
+            except Exception as e:
+                print(colored(f"Failed to resume document ingestion: {e}", "red"))
+            await asyncio.sleep(interval)
+
+    def _start(self, document: Dict):
+        task = asyncio.create_task(self._ingest(document))
+        self._running[document["id"]] = task
+        task.add_done_callback(lambda _: self._running.pop(document["id"], None))
+
+    async def _ingest(self, document: Dict):
+        document_id = document["id"]
+        try:
+            chunk_count, embedded = await self._run_pipeline(document)
+        except Exception as e:
+            print(colored(f"Failed to ingest document {document_id}: {e}", "red"))
+            await asyncio.to_thread(
+                self.supabase.update_document, document_id, {"status": "failed"}
+            )
+            return
+        await asyncio.to_thread(
+            self.supabase.update_document,
+            document_id,
+            {"status": "ready", "chunk_count": chunk_count},
+        )
+        print(
+            colored(
+                f"Ingested document {document_id}: {chunk_count} chunks, {embedded} embedded",
+                "green",
+            )
+        )
+
+    async def _run_pipeline(self, document: Dict) -> Tuple[int, int]:
+        """Returns the number of chunks of the document and of chunks embedded."""
+        document_id = document["id"]
+        loop = asyncio.get_running_loop()
+
+        data, existing = await asyncio.gather(
+            asyncio.to_thread(self.supabase.download_document, document["path"]),
+            asyncio.to_thread(self.supabase.fetch_chunk_hashes, document_id),
+        )
+        if not _is_text(data):
+            raise ValueError("Only text documents are supported")
+        reusable = ChunkIndex(existing)
+
+        # Chunking is CPU bound, each batch is produced in a thread
+        batches = iter_batches(iter_chunks(iter_text(data)))
+        embedding: deque = deque()
+        rows: List[Dict] = []
+        moves: List[Dict] = []
+        # Chunks written or reused so far, and chunks embedded among them
+        chunk_count = embedded = 0
+
+        async def write(flush: bool = False):
+            nonlocal chunk_count
+            if len(rows) + len(moves) < INSERT_BATCH_SIZE and not flush:
+                return
+            if rows:
+                await asyncio.to_thread(self.supabase.insert_chunks, rows.copy())
+            if moves:
+                await asyncio.to_thread(
+                    self.supabase.move_chunks, document_id, moves.copy()
+                )
+            chunk_count += len(rows) + len(moves)
+            rows.clear()
+            moves.clear()
+            # Also tells other workers the ingestion is alive
+            await asyncio.to_thread(
+                self.supabase.update_document, document_id, {"chunk_count": chunk_count}
+            )
+
+        async def store():
+            nonlocal embedded
+            batch, future = embedding.popleft()
+            embeddings = await future
+            embedded += len(batch)
+            rows.extend(
+                {
+                    "document_id": document_id,
+                    "user_id": document.get("user_id"),
+                    "chunk_index": index,
+                    "content": content,
+                    "content_hash": digest,
+                    "embedding": vector,
+                    "enabled": True,
+                }
+                for (index, content, digest), vector in zip(batch, embeddings)
+            )
+            await write()
+
+        try:
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                changed = []
+                for index, content in batch:
+                    digest = content_hash(content)
+                    chunk = reusable.take(digest, index)
+                    if chunk is None:
+                        changed.append((index, content, digest))
+                    elif chunk["chunk_index"] != index or not chunk["enabled"]:
+                        moves.append({"id": chunk["id"], "chunk_index": index})
+                    else:
+                        chunk_count += 1
+                if changed:
+                    future = loop.run_in_executor(
+                        _get_pool(),
+                        embed_texts,
+                        self.model_name,
+                        [content for _, content, _ in changed],
+                    )
+                    embedding.append((changed, future))
+                if len(embedding) >= EMBED_IN_FLIGHT:
+                    await store()
+                else:
+                    await write()
+            while embedding:
+                await store()
+            await write(flush=True)
+        finally:
+            for _, future in embedding:
+                future.cancel()
+
+        # Disabled rather than deleted, search skips them and they are reused if their
+        # content comes back
+        await asyncio.to_thread(self.supabase.disable_chunks, reusable.leftover_ids())
+        return chunk_count, embedded
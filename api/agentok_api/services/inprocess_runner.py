@@ -0,0 +1,190 @@
+import asyncio
+import builtins
+import queue
+import re
+import runpy
+import signal
+import threading
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from autogen.io.base import IOStream
+from termcolor import colored
+
+# termcolor may color the output when the API runs in a terminal, which would break the parser
+ANSI_ESCAPE_PATTERN = re.compile(r"\x1b\[[0-9;]*m")
+
+
+class ChatAborted(Exception):
+    """Raised in the chat thread when the chat is aborted by the user."""
+
+
+class InProcessIO:
+    """The input/output stream of one chat running inside the API process.
+
+    It's set as the default IOStream of autogen in the chat thread, so agent output ends up
+    here, and `print`/`input` of the generated module are routed to it as well. Complete
+    lines are handed to the event loop, waiting until `on_line` accepted them, while input
+    is read from a queue fed by `send`.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        on_line: Callable[[str], Awaitable[None]],
+    ):
+        self._loop = loop
+        self._on_line = on_line
+        self._buffer = ""
+        self._input = queue.Queue()
+        self.aborted = threading.Event()
+        # Resolved with the exit code and error message once the chat thread is done
+        self.finished: Optional[asyncio.Future] = None
+
+    def print(
+        self, *objects, sep: str = " ", end: str = "\n", flush: bool = False, file=None
+    ):
+        if file is not None:
+            # Writes to explicit files such as sys.stderr are not part of the chat output
+            builtins.print(*objects, sep=sep, end=end, flush=flush, file=file)
+            return
+        if self.aborted.is_set():
+            raise ChatAborted()
+
+        self._buffer += ANSI_ESCAPE_PATTERN.sub(
+            "", sep.join(str(obj) for obj in objects) + end
+        )
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._emit(line)
+
+    def input(self, prompt: str = "", *, password: bool = False) -> str:
+        # Same status lines as the get_human_input of generated code run in a subprocess
+        self.print("__STATUS_WAIT_FOR_HUMAN_INPUT__", prompt)
+        if prompt:
+            self.print(prompt, end="")
+        reply = self._input.get()
+        if reply is None or self.aborted.is_set():
+            raise ChatAborted()
+        self.print("__STATUS_RECEIVED_HUMAN_INPUT__", prompt)
+        return reply
+
+    def send(self, user_input: str):
+        self._input.put(user_input)
+
+    def abort(self):
+        self.aborted.set()
+        # Wake up the chat thread if it's waiting for human input
+        self._input.put(None)
+
+    def close(self):
+        if self._buffer:
+            self._emit(self._buffer)
+            self._buffer = ""
+
+    def _emit(self, line: str):
+        asyncio.run_coroutine_threadsafe(self._on_line(line), self._loop).result()
+
+
+# print and input of the generated module, dispatched on autogen's default IOStream, which
+# is kept per thread, so concurrent chats are kept apart.
+def _print(*objects, **kwargs):
+    IOStream.get_default().print(*objects, **kwargs)
+
+
+def _input(prompt: str = "") -> str:
+    return IOStream.get_default().input(prompt)
+
+
+class InProcessRunner:
+    """Runs generated flows inside the API process instead of a separate interpreter.
+
+    Each chat runs in a dedicated thread, which avoids the startup cost of a new Python
+    process and of importing autogen for every chat. It's only meant for trusted projects,
+    as the flow (including tool code) runs with the privileges of the API.
+    """
+
+    def __init__(self):
+        self._runs: Dict[str, InProcessIO] = {}
+
+    def is_running(self, chat_id: str) -> bool:
+        return chat_id in self._runs
+
+    async def run(
+        self,
+        chat_id: str,
+        message: str,
+        source_path: str,
+        on_line: Callable[[str], Awaitable[None]],
+        extra_env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        """Run the generated module and return its exit code and error message."""
+        loop = asyncio.get_running_loop()
+        # A chat runs once at a time, the previous run would otherwise keep going unseen
+        await self.stop(chat_id)
+        io = InProcessIO(loop, on_line)
+        done = loop.create_future()
+        io.finished = done
+        self._runs[chat_id] = io
+
+        def target():
+            returncode, error_message = 0, ""
+            with IOStream.set_default(io):
+                try:
+                    runpy.run_path(
+                        source_path,
+                        init_globals={
+                            "initial_message": message,
+                            "tool_environ": extra_env or {},
+                            "print": _print,
+                            "input": _input,
+                        },
+                        run_name=f"agentok_chat_{chat_id}",
+                    )
+                except ChatAborted:
+                    # Same as a subprocess terminated by abort_assistant
+                    returncode = -signal.SIGTERM
+                except SystemExit as e:
+                    returncode = (
+                        e.code if isinstance(e.code, int) else int(bool(e.code))
+                    )
+                except BaseException as e:
+                    returncode, error_message = 1, f"{type(e).__name__}: {e}"
+                finally:
+                    io.close()
+            loop.call_soon_threadsafe(done.set_result, (returncode, error_message))
+
+        print(colored(f"Running {source_path} in process", "blue"))
+        thread = threading.Thread(target=target, name=f"chat-{chat_id}", daemon=True)
+        thread.start()
+        try:
+            return await asyncio.shield(done)
+        finally:
+            # A newer run of the chat may have replaced this one
+            if self._runs.get(chat_id) is io:
+                del self._runs[chat_id]
+
+    async def stop(self, chat_id: str) -> bool:
+        """Abort the run of a chat, if any, and wait for its thread to be done."""
+        io = self._runs.get(chat_id)
+        if io is None:
+            return False
+        print(
+            colored(f"Found existing run for chat_id {chat_id}. Aborting...", "yellow")
+        )
+        io.abort()
+        await asyncio.shield(io.finished)
+        return True
+
+    def send_human_input(self, chat_id: str, user_input: str) -> bool:
+        io = self._runs.get(chat_id)
+        if io is None:
+            return False
+        io.send(user_input)
+        return True
+
+    def abort(self, chat_id: str) -> bool:
+        io = self._runs.get(chat_id)
+        if io is None:
+            return False
+        io.abort()
+        return True
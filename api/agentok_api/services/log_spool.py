@@ -0,0 +1,285 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, TextIO
+
+from .supabase import Client, create_supabase_client
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+SPOOL_DIR = os.environ.get("AGENTOK_LOG_SPOOL_DIR") or os.path.join(
+    tempfile.gettempdir(), "agentok", "log-spool"
+)
+# Segments are rotated once they reach this size
+SEGMENT_MAX_BYTES = 1024 * 1024
+# Active segments idle for this long are sealed, so their logs get shipped
+SEAL_IDLE_SECONDS = 2.0
+# Active segments left behind by a dead process are sealed after this long
+STALE_SEGMENT_SECONDS = 600.0
+# Seconds between two shipping rounds
+SHIP_INTERVAL = 1.0
+# Rows per bulk insert
+SHIP_BATCH_SIZE = 500
+
+ACTIVE_SUFFIX = ".open"
+SEALED_SUFFIX = ".ndjson"
+OFFSET_SUFFIX = ".offset"
+
+
+class LogSpool:
+    """Append-only local spool of chat logs, shipped to the database in the background.
+
+    Its methods do blocking file I/O, call them from a thread when on the event loop.
+
+    Each chat has its own directory of NDJSON segments named by sequence number. The segment
+    being written ends with `.open` and is renamed to `.ndjson` (sealed) when it's full or
+    idle. Only sealed segments are shipped. The number of rows already shipped from a
+    segment is kept in a `.offset` file, so shipping resumes where it stopped after a
+    restart, and the segment is deleted once it's fully shipped.
+    """
+
+    def __init__(
+        self, root: str = SPOOL_DIR, segment_max_bytes: int = SEGMENT_MAX_BYTES
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.Lock()
+        # chat_id -> (file, path, last write time) of the segments written by this process
+        self._active: Dict[str, tuple] = {}
+
+    def append(self, chat_id, row: Dict):
+        chat_id = str(chat_id)
+        row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+        line = json.dumps(row, separators=(",", ":"), ensure_ascii=False) + "\n"
+        with self._lock:
+            file, path, _ = self._active.get(chat_id) or self._open_segment(chat_id)
+            file.write(line)
+            file.flush()
+            self._active[chat_id] = (file, path, time.monotonic())
+            if file.tell() >= self.segment_max_bytes:
+                self._seal(chat_id)
+
+    def seal_idle(self, idle_seconds: float = SEAL_IDLE_SECONDS):
+        now = time.monotonic()
+        with self._lock:
+            for chat_id, (_, _, written_at) in list(self._active.items()):
+                if now - written_at >= idle_seconds:
+                    self._seal(chat_id)
+
+    def seal_all(self):
+        with self._lock:
+            for chat_id in list(self._active):
+                self._seal(chat_id)
+
+    def read_unshipped(self, chat_id) -> List[Dict]:
+        """Read the logs of a chat which are not in the database yet, oldest first."""
+        rows = []
+        # Not while a segment is being written or sealed, a line could be read half-written
+        # or a segment missed while it's renamed
+        with self._lock:
+            for path in self._segments(str(chat_id), include_active=True):
+                rows.extend(self._read_segment(path)[self._read_offset(path) :])
+        return rows
+
+    def chats(self) -> List[str]:
+        return [path.name for path in self.root.iterdir() if path.is_dir()]
+
+    def sealed_segments(self, chat_id: str) -> List[Path]:
+        # Seal what a dead process left behind, nobody is going to write it anymore
+        for path in self._segments(chat_id, include_active=True):
+            if path.suffix == ACTIVE_SUFFIX and self._is_stale(path):
+                path.rename(path.with_suffix(SEALED_SUFFIX))
+        return self._segments(chat_id, include_active=False)
+
+    def _segments(self, chat_id: str, include_active: bool) -> List[Path]:
+        chat_dir = self.root / chat_id
+        if not chat_dir.is_dir():
+            return []
+        suffixes = {SEALED_SUFFIX, ACTIVE_SUFFIX} if include_active else {SEALED_SUFFIX}
+        return sorted(
+            (path for path in chat_dir.iterdir() if path.suffix in suffixes),
+            key=lambda path: int(path.stem),
+        )
+
+    def _open_segment(self, chat_id: str) -> tuple:
+        chat_dir = self.root / chat_id
+        chat_dir.mkdir(parents=True, exist_ok=True)
+        existing = [
+            int(path.stem)
+            for path in chat_dir.iterdir()
+            if path.suffix in (SEALED_SUFFIX, ACTIVE_SUFFIX)
+        ]
+        path = chat_dir / f"{max(existing, default=0) + 1:08d}{ACTIVE_SUFFIX}"
+        try:
+            file = open(path, "a", encoding="utf-8")
+        except FileNotFoundError:
+            # The shipper of another process removed the directory in the meantime
+            chat_dir.mkdir(parents=True, exist_ok=True)
+            file = open(path, "a", encoding="utf-8")
+        return file, path, time.monotonic()
+
+    def _seal(self, chat_id: str):
+        file, path, _ = self._active.pop(chat_id)
+        file.close()
+        path.rename(path.with_suffix(SEALED_SUFFIX))
+
+    def _is_stale(self, path: Path) -> bool:
+        if any(active_path == path for _, active_path, _ in self._active.values()):
+            return False
+        return time.time() - path.stat().st_mtime >= STALE_SEGMENT_SECONDS
+
+    @staticmethod
+    def _read_segment(path: Path) -> List[Dict]:
+        rows = []
+        try:
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        rows.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash
+                        continue
+        except FileNotFoundError:
+            # Shipped and removed in the meantime
+            pass
+        return rows
+
+    @staticmethod
+    def _read_offset(path: Path) -> int:
+        try:
+            return int(path.with_suffix(OFFSET_SUFFIX).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+
+class LogShipper:
+    """Background thread bulk-inserting the sealed segments of a LogSpool into `chat_logs`.
+
+    With several API workers sharing the spool directory, a lock file makes sure only one
+    of them ships at a time.
+    """
+
+    def __init__(
+        self,
+        spool: LogSpool,
+        supabase: Client,
+        interval: float = SHIP_INTERVAL,
+        batch_size: int = SHIP_BATCH_SIZE,
+    ):
+        self.spool = spool
+        self.supabase = supabase
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="chat-log-shipper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Seal everything and make a last attempt to ship it."""
+        self._stopped.set()
+        self._thread.join(timeout)
+        self.spool.seal_all()
+        self.ship()
+
+    def ship(self):
+        with self._shipping_lock() as acquired:
+            if not acquired:
+                return
+            for chat_id in self.spool.chats():
+                for path in self.spool.sealed_segments(chat_id):
+                    if not self._ship_segment(path):
+                        # Keep the order of the logs, retry this chat on the next round
+                        break
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.spool.seal_idle()
+                self.ship()
+            except Exception as e:
+                print(f"Failed to ship chat logs: {e}", file=sys.__stderr__)
+
+    def _ship_segment(self, path: Path) -> bool:
+        rows = LogSpool._read_segment(path)
+        offset = LogSpool._read_offset(path)
+        offset_path = path.with_suffix(OFFSET_SUFFIX)
+        while offset < len(rows):
+            batch = rows[offset : offset + self.batch_size]
+            try:
+                self.supabase.table("chat_logs").insert(batch).execute()
+            except Exception as e:
+                print(f"Failed to ship logs from {path}: {e}", file=sys.__stderr__)
+                return False
+            offset += len(batch)
+            offset_path.write_text(str(offset))
+
+        path.unlink(missing_ok=True)
+        offset_path.unlink(missing_ok=True)
+        # Not while this process opens a segment in the directory
+        with self.spool._lock:
+            if path.parent != self.spool.root and not any(path.parent.iterdir()):
+                try:
+                    path.parent.rmdir()
+                except OSError:
+                    # A new segment was just opened
+                    pass
+        return True
+
+    def _shipping_lock(self):
+        if fcntl is None:
+            return nullcontext(True)
+        return _FileLock(self.spool.root / ".ship.lock")
+
+
+class _FileLock:
+    def __init__(self, path: Path):
+        self.path = path
+        self.file: Optional[TextIO] = None
+
+    def __enter__(self) -> bool:
+        self.file = open(self.path, "a")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def __exit__(self, *args):
+        # Closing the file releases the lock
+        self.file.close()
+        return False
+
+
+_spool: Optional[LogSpool] = None
+_shipper: Optional[LogShipper] = None
+_spool_lock = threading.Lock()
+
+
+def get_log_spool() -> LogSpool:
+    """Return the spool of this process, starting its shipper on first use."""
+    global _spool, _shipper
+    with _spool_lock:
+        if _spool is None:
+            _spool = LogSpool()
+            _shipper = LogShipper(_spool, create_supabase_client().supabase)
+        return _spool
+
+
+def close_log_spool():
+    global _spool, _shipper
+    with _spool_lock:
+        shipper, _spool, _shipper = _shipper, None, None
+    if shipper is not None:
+        shipper.stop()
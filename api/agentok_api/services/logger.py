@@ -1,16 +1,145 @@
-import sys
+import atexit
 import logging
-from typing import Optional
+import sys
+import threading
+from collections import deque
 from contextlib import contextmanager
-from io import StringIO
-from .supabase import create_supabase_client, Client
+from typing import Dict, List, Optional
+
+from .supabase import Client, create_supabase_client
+
+# Rows are inserted in batches of up to this size
+MAX_BATCH_SIZE = 500
+# Seconds to wait for more rows before inserting a partial batch
+FLUSH_INTERVAL = 0.5
+# Rows kept in memory while the database is slow, the oldest ones are dropped beyond that
+MAX_BUFFER_SIZE = 10000
+
+
+class BatchingLogWriter:
+    """Buffers `chat_logs` rows and inserts them in bulk from a background thread.
+
+    Writers never wait on the database: `write` only appends to a bounded buffer, which
+    drops the oldest rows when it's full. Remaining rows are flushed on `close`, which is
+    also registered to run at interpreter exit, so the writer can be used both by the API
+    and by generated programs.
+    """
+
+    def __init__(
+        self,
+        supabase: Client,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        max_buffer_size: int = MAX_BUFFER_SIZE,
+    ):
+        self.supabase = supabase
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.dropped = 0
+
+        self._buffer = deque()
+        self._in_flight = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="chat-log-writer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, row: Dict):
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._buffer) >= self.max_buffer_size:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(row)
+            if len(self._buffer) >= self.max_batch_size:
+                self._condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all rows written so far are inserted. Returns False on timeout."""
+        with self._condition:
+            self._condition.notify_all()
+            return self._condition.wait_for(
+                lambda: not self._buffer and not self._in_flight, timeout
+            )
+
+    def close(self, timeout: float = 5.0):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        if self.dropped:
+            print(
+                f"Dropped {self.dropped} chat logs, the buffer was full",
+                file=sys.__stderr__,
+            )
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or len(self._buffer) >= self.max_batch_size,
+                    self.flush_interval,
+                )
+                if not self._buffer:
+                    if self._closed:
+                        return
+                    continue
+                batch = [
+                    self._buffer.popleft()
+                    for _ in range(min(self.max_batch_size, len(self._buffer)))
+                ]
+                self._in_flight = len(batch)
+
+            self._insert(batch)
+
+            with self._condition:
+                self._in_flight = 0
+                self._condition.notify_all()
+
+    def _insert(self, rows: List[Dict]):
+        try:
+            self.supabase.table("chat_logs").insert(rows).execute()
+        except Exception as e:
+            print(
+                f"Failed to write {len(rows)} logs to Supabase: {e}",
+                file=sys.__stderr__,
+            )
+
+
+_log_writer: Optional[BatchingLogWriter] = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer() -> BatchingLogWriter:
+    """Return the log writer shared by the whole process."""
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = BatchingLogWriter(create_supabase_client().supabase)
+        return _log_writer
+
+
+def close_log_writer():
+    global _log_writer
+    with _log_writer_lock:
+        writer, _log_writer = _log_writer, None
+    if writer is not None:
+        writer.close()
+
 
 class SupabaseLogHandler(logging.Handler):
-    def __init__(self, supabase: Client, chat_id: int):
+    def __init__(self, writer: BatchingLogWriter, chat_id: int):
         super().__init__()
-        self.supabase = supabase
+        self.writer = writer
         self.chat_id = chat_id
-        
+
     def emit(self, record: logging.LogRecord):
         try:
             log_entry = {
@@ -20,45 +149,60 @@ class SupabaseLogHandler(logging.Handler):
                 "metadata": {
                     "filename": record.filename,
                     "lineno": record.lineno,
-                    "funcName": record.funcName
-                }
+                    "funcName": record.funcName,
+                },
             }
-            self.supabase.table("chat_logs").insert(log_entry).execute()
-        except Exception as e:
-            print(f"Failed to write to Supabase: {e}", file=sys.__stderr__)
+            self.writer.write(log_entry)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.writer.flush()
+
 
 class StreamToLogger:
-    def __init__(self, supabase: Client, chat_id: int, level: str):
-        self.supabase = supabase
+    def __init__(self, writer: BatchingLogWriter, chat_id: int, level: str):
+        self.writer = writer
         self.chat_id = chat_id
         self.level = level
-        self.buffer = StringIO()
+        self.buffer = ""
 
     def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            log_entry = {
-                "chat_id": self.chat_id,
-                "level": self.level,
-                "message": line
-            }
-            self.supabase.table("chat_logs").insert(log_entry).execute()
-            
+        # print() writes the text and the line ending separately, so only complete lines are logged
+        self.buffer += buf
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            self._write_line(line)
+        return len(buf)
+
+    def _write_line(self, line: str):
+        line = line.rstrip()
+        if line:
+            self.writer.write(
+                {"chat_id": self.chat_id, "level": self.level, "message": line}
+            )
+
     def flush(self):
-        pass
+        if self.buffer:
+            self._write_line(self.buffer)
+            self.buffer = ""
+
 
 @contextmanager
 def capture_output(chat_id: int):
     """Captures stdout and stderr, sending them to Supabase logs table."""
-    supabase = create_supabase_client()
-    
+    writer = get_log_writer()
+
     # Redirect stdout and stderr to our custom handlers
-    stdout_logger = StreamToLogger(supabase, chat_id, "stdout")
-    stderr_logger = StreamToLogger(supabase, chat_id, "stderr")
-    
+    stdout_logger = StreamToLogger(writer, chat_id, "stdout")
+    stderr_logger = StreamToLogger(writer, chat_id, "stderr")
+
     old_stdout, old_stderr = sys.stdout, sys.stderr
     sys.stdout, sys.stderr = stdout_logger, stderr_logger
-    
+
     try:
         yield
     finally:
-        sys.stdout, sys.stderr = old_stdout, old_stderr 
\ No newline at end of file
+        stdout_logger.flush()
+        stderr_logger.flush()
+        sys.stdout, sys.stderr = old_stdout, old_stderr
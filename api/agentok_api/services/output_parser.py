@@ -1,18 +1,28 @@
-import re
+import ast
 import json
+import re
 from dataclasses import dataclass
-from typing import List, Dict, Optional
-import ast
+from typing import Dict, List, Optional
 
 from fastapi import logger
 
+
 @dataclass
 class ChatResult:
     chat_id: Optional[str]
-    chat_history: List[Dict[str, str]]
     summary: str
     cost: Dict
     human_input: List
+    # The messages themselves are printed and stored one by one, only their number is kept
+    message_count: int = 0
+    # Printed in full by code generated before message_count
+    chat_history: Optional[List[Dict[str, str]]] = None
+
+    def __post_init__(self):
+        if self.chat_history is not None:
+            self.message_count = self.message_count or len(self.chat_history)
+            self.chat_history = None
+
 
 class OutputParser:
     # Define states as class-level immutable constants
@@ -26,6 +36,8 @@ class OutputParser:
         # Initial state
         self.state = self.STATE_CHAT
         self.on_message = on_message
+        # Index of the sequential chat running, announced by the generated code
+        self.chat_index = 0
 
         # Initialize patterns
         self._initialize_patterns()
@@ -62,58 +74,79 @@ class OutputParser:
         }
         self.message_content = []
 
-    def parse_line(self, line: str):
+    def parse_line(self, line: str) -> Optional[str]:
         """Parse a single line of output.
-        
+
         This method maintains state between calls and handles different types of output:
         - Chat messages
         - Status updates
         - Chat results
+
+        Returns:
+            Optional[str]: The chat status indicated by the line, or None if it doesn't change it
         """
         # Skip empty lines
         if not line:
-            return
+            return None
 
-        # Handle status messages first
-        if self._handle_status_message(line):
-            return
+        # Handle status messages first, all status markers share the same prefix
+        if "__STATUS_" in line:
+            status = self._handle_status_message(line)
+            if status:
+                return status
+
+        # Handle the start of a sequential chat
+        if line.startswith("__CHAT_START__ "):
+            try:
+                self.chat_index = int(line.split()[1])
+            except (IndexError, ValueError):
+                print(f"Error parsing chat start: {line}")
+            return None
 
         # Handle chat results
         if "__CHAT_RESULT__ " in line:
             result = self.parse_chat_result(line)
             if result:
-                self.on_message({
-                    "type": "summary",
-                    "content": result.summary,
-                    "metadata": {
-                        "summary": result.summary,
-                        "chat_history": result.chat_history,
-                        "cost": result.cost,
-                        "human_input": result.human_input
-                    },
-                })
+                self.on_message(
+                    {
+                        "type": "summary",
+                        "content": result.summary,
+                        "metadata": {
+                            "summary": result.summary,
+                            "message_count": result.message_count,
+                            "cost": result.cost,
+                            "human_input": result.human_input,
+                        },
+                    }
+                )
             else:
                 print(f"Error parsing chat result: {line}")
-            return
+            return None
 
         # Handle multiple chat results
         if "__CHAT_RESULTS__ " in line:
             results = self.parse_chat_results(line)
             if results:
                 # Combine all results into one message
-                self.on_message({
-                    "type": "summary",
-                    "content": "\n\n".join(r.summary.strip() for r in results).strip(),
-                    "metadata": {
-                        "summaries": [result.summary for result in results],
-                        "chat_histories": [result.chat_history for result in results],
-                        "costs": [result.cost for result in results],
-                        "human_inputs": [result.human_input for result in results]
-                    },
-                })
+                self.on_message(
+                    {
+                        "type": "summary",
+                        "content": "\n\n".join(
+                            r.summary.strip() for r in results
+                        ).strip(),
+                        "metadata": {
+                            "summaries": [result.summary for result in results],
+                            "message_counts": [
+                                result.message_count for result in results
+                            ],
+                            "costs": [result.cost for result in results],
+                            "human_inputs": [result.human_input for result in results],
+                        },
+                    }
+                )
             else:
                 print(f"Error parsing chat results: {line}")
-            return
+            return None
 
         # Handle normal chat messages
         handlers = {
@@ -124,6 +157,7 @@ class OutputParser:
 
         handler = handlers.get(self.state, lambda x: None)
         handler(line)
+        return None
 
     def _handle_version_state(self, line):
         if self.version_pattern.match(line):
@@ -181,8 +215,8 @@ class OutputParser:
             match = self.arguments_pattern.match(line)
             if match:
                 try:
-                    self.current_message["metadata"]["tool_info"]["arguments"] = json.loads(
-                        match.group(1).replace("'", '"')
+                    self.current_message["metadata"]["tool_info"]["arguments"] = (
+                        json.loads(match.group(1).replace("'", '"'))
                     )
                 except json.JSONDecodeError:
                     self.current_message["metadata"]["tool_info"]["arguments"] = None
@@ -204,6 +238,7 @@ class OutputParser:
         self.current_message["content"] = "\n".join(self.message_content).strip()
 
         if self.on_message:
+            self.current_message["chat_index"] = self.chat_index
             self.on_message(self.current_message)
 
         # Prepare for the next message
@@ -219,23 +254,23 @@ class OutputParser:
 
     def parse_chat_result(self, result_str: str) -> Optional[ChatResult]:
         """Parse a chat result string into a ChatResult object.
-        
+
         Args:
             result_str: The string containing the chat result in JSON format
-            
+
         Returns:
             Optional[ChatResult]: The parsed chat result, or None if parsing failed
         """
         try:
             # Remove the "__CHAT_RESULT__ " prefix
             clean_str = result_str.replace("__CHAT_RESULT__ ", "")
-            
+
             # Parse the JSON string
             result_dict = json.loads(clean_str)
-            
+
             # Convert the dictionary to a ChatResult object
             return ChatResult(**result_dict)
-            
+
         except Exception as e:
             logger.error(f"Error parsing chat result: {e}")
             logger.error(f"Input string was: {result_str}")
@@ -243,48 +278,50 @@ class OutputParser:
 
     def parse_chat_results(self, results_str: str) -> Optional[List[ChatResult]]:
         """Parse multiple chat results string into a list of ChatResult objects.
-        
+
         Args:
             results_str: The string containing multiple chat results in JSON format
-            
+
         Returns:
             Optional[List[ChatResult]]: The parsed chat results, or None if parsing failed
         """
         try:
             # Remove the "__CHAT_RESULTS__ " prefix
             clean_str = results_str.replace("__CHAT_RESULTS__ ", "")
-            
+
             # Parse the JSON string
             results_list = json.loads(clean_str)
-            
+
             # Convert each dictionary to a ChatResult object
             return [ChatResult(**result_dict) for result_dict in results_list]
-            
+
         except Exception as e:
             logger.error(f"Error parsing chat results: {e}")
             logger.error(f"Input string was: {results_str}")
             return None
 
-    def _handle_status_message(self, message: str) -> bool:
+    def _handle_status_message(self, message: str) -> Optional[str]:
         """
-        Handle status messages and return True if the message was a status message.
-        Returns False otherwise.
+        Handle status messages and return the chat status if the message was a status message.
+        Returns None otherwise.
         """
         status_prefixes = [
             "__STATUS_RECEIVED_HUMAN_INPUT__",
             "__STATUS_WAIT_FOR_HUMAN_INPUT__",
-            "__STATUS_COMPLETED__"
+            "__STATUS_COMPLETED__",
         ]
-        
+
         for prefix in status_prefixes:
             if prefix in message:
                 content = self._strip_prefix(message, status_prefixes)
-                self.on_message({
-                    "type": "assistant",
-                    "content": content,
-                })
-                return True
-        return False
+                self.on_message(
+                    {
+                        "type": "assistant",
+                        "content": content,
+                    }
+                )
+                return self.get_chat_status(message)
+        return None
 
     def _strip_prefix(self, input_string: str, substrings: list[str]) -> str:
         """Strip status prefix from a message."""
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List
+
+from .output_parser import OutputParser
+
+logger = logging.getLogger(__name__)
+
+# Echoing every line of assistant output to the console is costly, so it's opt-in
+ECHO_OUTPUT = os.environ.get("AGENTOK_ECHO_OUTPUT", "").lower() in ("1", "true")
+
+# Maximum number of items waiting in each stage, the reader blocks when the parser falls behind
+QUEUE_SIZE = 1000
+
+_END = object()
+
+
+class OutputPipeline:
+    """Moves assistant output through staged async workers over bounded queues.
+
+    The reader feeds lines with `put`. A parser stage runs the OutputParser once per line
+    and fans the results out to three sink stages:
+
+    - the log sink receives every line,
+    - the message sink receives the messages assembled by the parser,
+    - the status sink receives the chat status derived from status lines.
+
+    Each sink runs in its own task, so a slow database write delays neither the parser
+    nor the other sinks, until its queue fills up.
+    """
+
+    def __init__(
+        self,
+        output_parser: OutputParser,
+        log_sink: Callable[[str], Awaitable[Any]],
+        message_sink: Callable[[Dict], Awaitable[Any]],
+        status_sink: Callable[[str], Awaitable[Any]],
+        echo: bool = ECHO_OUTPUT,
+        maxsize: int = QUEUE_SIZE,
+    ):
+        self.output_parser = output_parser
+        self.echo = echo
+
+        # The parser calls on_message synchronously, the messages are queued after each line
+        self._pending_messages: List[Dict] = []
+        self.output_parser.on_message = self._pending_messages.append
+
+        self._lines = asyncio.Queue(maxsize)
+        self._logs = asyncio.Queue(maxsize)
+        self._messages = asyncio.Queue(maxsize)
+        self._statuses = asyncio.Queue(maxsize)
+        self._tasks = [
+            asyncio.create_task(self._parse()),
+            asyncio.create_task(self._drain(self._logs, log_sink, "log")),
+            asyncio.create_task(self._drain(self._messages, message_sink, "message")),
+            asyncio.create_task(self._drain(self._statuses, status_sink, "status")),
+        ]
+
+    async def put(self, line: str):
+        self._check_parser()
+        await self._lines.put(line)
+
+    async def close(self):
+        """Wait until every line fed so far went through all the stages."""
+        self._check_parser()
+        await self._lines.put(_END)
+        await asyncio.gather(*self._tasks)
+
+    def _check_parser(self):
+        # Nothing reads the lines once the parser stopped, putting more would block forever
+        parser = self._tasks[0]
+        if parser.done():
+            if not parser.cancelled() and parser.exception() is not None:
+                raise parser.exception()
+            raise RuntimeError("Output pipeline is closed")
+
+    async def _parse(self):
+        try:
+            while (line := await self._lines.get()) is not _END:
+                if self.echo:
+                    print("📺 ", line)
+                await self._logs.put(line)
+
+                try:
+                    status = self.output_parser.parse_line(line)
+                except Exception as e:
+                    logger.error(f"Failed to parse line in output pipeline: {e}")
+                    status = None
+                for message in self._pending_messages:
+                    await self._messages.put(message)
+                self._pending_messages.clear()
+                if status:
+                    await self._statuses.put(status)
+        finally:
+            for queue in (self._logs, self._messages, self._statuses):
+                await queue.put(_END)
+
+    async def _drain(
+        self, queue: asyncio.Queue, sink: Callable[[Any], Awaitable[Any]], name: str
+    ):
+        while (item := await queue.get()) is not _END:
+            try:
+                await sink(item)
+            except Exception as e:
+                logger.error(f"Failed to handle {name} in output pipeline: {e}")
+
+
+def sync_sink(func: Callable[..., Any], *args) -> Callable[[Any], Awaitable[Any]]:
+    """Wrap a blocking callback, such as a database write, to run outside the event loop."""
+    if asyncio.iscoroutinefunction(func):
+        return lambda item: func(*args, item)
+    return lambda item: asyncio.to_thread(func, *args, item)
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from fastapi import HTTPException, status
+from termcolor import colored
+
+from .embeddings import EmbeddingService
+from .supabase import SupabaseClient
+
+# Damps the weight of the first ranks in Reciprocal Rank Fusion, 60 is the usual value
+RRF_K = 60
+# Chunks taken from each search before fusion
+SEARCH_CANDIDATES = 50
+# Fused chunks passed to the reranker
+RERANK_TOP_N = 20
+# Reranker used unless the request picks one: "cross-encoder", "cohere" or "none"
+RERANKER = os.environ.get("AGENTOK_RERANKER") or "none"
+CROSS_ENCODER_MODEL = (
+    os.environ.get("AGENTOK_CROSS_ENCODER_MODEL")
+    or "cross-encoder/ms-marco-MiniLM-L-6-v2"
+)
+COHERE_RERANK_MODEL = "rerank-english-v3.0"
+
+RERANKERS = ("none", "cross-encoder", "cohere")
+
+
+def rrf_fuse(rankings: List[List[Dict]], k: int = RRF_K) -> List[Dict]:
+    """Merge ranked lists of chunks by Reciprocal Rank Fusion.
+
+    A chunk scores the sum of 1 / (k + rank) over the lists it appears in, so it only takes
+    ranks into account, not the scores of the searches which aren't comparable.
+    """
+    fused: Dict[int, Dict] = {}
+    for ranking in rankings:
+        for rank, chunk in enumerate(ranking, start=1):
+            entry = fused.setdefault(chunk["id"], {**chunk, "score": 0.0})
+            entry.update(
+                (key, value) for key, value in chunk.items() if key not in entry
+            )
+            entry["score"] += 1 / (k + rank)
+
+    # The same content may be indexed in several datasets, keep its best chunk
+    distinct = {}
+    for chunk in sorted(fused.values(), key=lambda c: -c["score"]):
+        distinct.setdefault(
+            hashlib.md5(chunk["content"].encode("utf-8")).digest(), chunk
+        )
+    return list(distinct.values())
+
+
+@contextmanager
+def _timed(timings: Dict[str, float], stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 2)
+
+
+class CrossEncoderReranker:
+    """Scores (query, chunk) pairs with a local cross-encoder, loaded on first use."""
+
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL):
+        self.model_name = model_name
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    def score(self, query: str, contents: List[str]) -> List[float]:
+        with self._model_lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+
+                print(colored(f"Loading reranking model {self.model_name}", "blue"))
+                self._model = CrossEncoder(self.model_name)
+        return self._model.predict([(query, content) for content in contents]).tolist()
+
+
+class CohereReranker:
+    """Scores chunks with the rerank endpoint of Cohere, requires COHERE_API_KEY."""
+
+    def __init__(self, model_name: str = COHERE_RERANK_MODEL):
+        self.model_name = model_name
+        self._client = None
+
+    def score(self, query: str, contents: List[str]) -> List[float]:
+        if self._client is None:
+            import cohere
+
+            self._client = cohere.Client(api_key=os.environ["COHERE_API_KEY"])
+        response = self._client.rerank(
+            model=self.model_name, query=query, documents=contents, top_n=len(contents)
+        )
+        scores = [0.0] * len(contents)
+        for result in response.results:
+            scores[result.index] = result.relevance_score
+        return scores
+
+
+# Rerankers keep their model or client, they are shared by the requests
+_rerankers = {"cross-encoder": CrossEncoderReranker(), "cohere": CohereReranker()}
+
+
+class RetrievalService:
+    """Hybrid search of the chunks of datasets.
+
+    The vector search and the full-text search run concurrently, their results are fused by
+    Reciprocal Rank Fusion, and the best fused chunks may be reranked by a cross-encoder or by
+    Cohere. The time spent in each stage is returned along with the chunks, in milliseconds.
+    """
+
+    def __init__(self, supabase: SupabaseClient, embeddings: EmbeddingService):
+        self.supabase = supabase
+        self.embeddings = embeddings
+
+    async def search(
+        self,
+        dataset_ids: List[int],
+        query: str,
+        top_k: int = 5,
+        reranker: Optional[str] = None,
+    ) -> Dict:
+        reranker = reranker or RERANKER
+        if reranker not in RERANKERS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown reranker {reranker}, expected one of {', '.join(RERANKERS)}",
+            )
+        dataset_ids = list(dict.fromkeys(dataset_ids))
+        owned = await asyncio.to_thread(self.supabase.fetch_dataset_ids, dataset_ids)
+        missing = set(dataset_ids) - set(owned)
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Datasets not found: {', '.join(map(str, sorted(missing)))}",
+            )
+
+        timings: Dict[str, float] = {}
+        with _timed(timings, "total"):
+            vector_chunks, lexical_chunks = await asyncio.gather(
+                self._vector_search(dataset_ids, query, timings),
+                self._lexical_search(dataset_ids, query, timings),
+            )
+            with _timed(timings, "fusion"):
+                chunks = rrf_fuse([vector_chunks, lexical_chunks])
+            if reranker != "none" and chunks:
+                with _timed(timings, "rerank"):
+                    chunks = await self._rerank(reranker, query, chunks)
+        return {"chunks": chunks[:top_k], "timings": timings}
+
+    async def _vector_search(
+        self, dataset_ids: List[int], query: str, timings: Dict[str, float]
+    ) -> List[Dict]:
+        with _timed(timings, "embedding"):
+            query_vector = await self.embeddings.embed(query)
+        with _timed(timings, "vector_search"):
+            chunks = await asyncio.to_thread(
+                self.supabase.search_chunks_multi,
+                dataset_ids,
+                query_vector,
+                SEARCH_CANDIDATES,
+            )
+        return chunks
+
+    async def _lexical_search(
+        self, dataset_ids: List[int], query: str, timings: Dict[str, float]
+    ) -> List[Dict]:
+        with _timed(timings, "lexical_search"):
+            chunks = await asyncio.to_thread(
+                self.supabase.search_chunks_lexical,
+                dataset_ids,
+                query,
+                SEARCH_CANDIDATES,
+            )
+        return chunks
+
+    async def _rerank(
+        self, reranker: str, query: str, chunks: List[Dict]
+    ) -> List[Dict]:
+        candidates, rest = chunks[:RERANK_TOP_N], chunks[RERANK_TOP_N:]
+        try:
+            scores = await asyncio.to_thread(
+                _rerankers[reranker].score, query, [c["content"] for c in candidates]
+            )
+        except Exception as e:
+            # The fused order is still a good one
+            print(colored(f"Failed to rerank chunks with {reranker}: {e}", "red"))
+            return chunks
+        for chunk, score in zip(candidates, scores):
+            chunk["rerank_score"] = score
+        candidates.sort(key=lambda c: -c["rerank_score"])
+        return candidates + rest
@@ -1,12 +1,22 @@
 import asyncio
-from typing import Dict, List, Literal, Optional
+import hashlib
+import heapq
 import logging
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Literal, Optional, Tuple, Union
 
 import requests
 from dotenv import load_dotenv
 from fastapi import HTTPException, status
 from gotrue import User
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
+from storage3.utils import StorageException
 from supabase import Client, create_client
 from termcolor import colored
 
@@ -15,17 +25,39 @@ from ..models import (
     ApiKeyCreate,
     Chat,
     ChatCreate,
-    LogCreate,
     Log,
+    LogCreate,
     Message,
     MessageCreate,
     Tool,
 )
+from ..utils.pagination import paginate, select_columns
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()  # Load environment variables from .env
 
+# Concurrent searches when datasets have to be searched one by one
+SEARCH_WORKERS = 8
+
+# Size of the candidate list of the HNSW index when searching chunks, trading speed for
+# recall. Left to the database (40) when unset.
+HNSW_EF_SEARCH = (
+    int(os.environ["AGENTOK_HNSW_EF_SEARCH"])
+    if os.environ.get("AGENTOK_HNSW_EF_SEARCH")
+    else None
+)
+
+# Paths of uploaded images remembered, to skip uploading them again
+UPLOADED_IMAGES_CACHE_SIZE = 4096
+
+# Chunks read per request, PostgREST caps responses at 1000 rows by default
+CHUNK_PAGE_SIZE = 1000
+
+# User authenticated by the current request. The client is shared by all requests, each
+# one sees its own user, as do the tasks and threads it starts.
+_user_id: ContextVar[Optional[str]] = ContextVar("supabase_user_id", default=None)
+
 
 class SupabaseClient:
     _instance = None
@@ -41,21 +73,34 @@ class SupabaseClient:
             self.supabase_url = os.environ.get("SUPABASE_URL")
             self.supabase_service_key = os.environ.get("SUPABASE_SERVICE_KEY")
             if not self.supabase_url or not self.supabase_service_key:
-                raise Exception("Supabase URL or key not found in environment variables")
+                raise Exception(
+                    "Supabase URL or key not found in environment variables"
+                )
             self.supabase: Client = create_client(
                 self.supabase_url, self.supabase_service_key
             )
-            self.user_id = None
+            # Paths of the images known to be in storage, by recency
+            self._uploaded_images: "OrderedDict[str, None]" = OrderedDict()
+            # The client is shared by the request threads
+            self._uploaded_images_lock = threading.Lock()
             self._initialized = True
 
+    @property
+    def user_id(self) -> Optional[str]:
+        return _user_id.get()
+
+    @user_id.setter
+    def user_id(self, user_id: Optional[str]):
+        _user_id.set(user_id)
+
     @classmethod
     def reset(cls):
         """Reset the singleton instance"""
         if cls._instance is not None:
-            if hasattr(cls._instance, 'supabase'):
+            if hasattr(cls._instance, "supabase"):
                 # Close any active connections if possible
                 try:
-                    if hasattr(cls._instance.supabase, 'client'):
+                    if hasattr(cls._instance.supabase, "client"):
                         cls._instance.supabase.client.close()
                 except:
                     pass
@@ -65,7 +110,7 @@ class SupabaseClient:
     def __del__(self):
         """Destructor to ensure resources are cleaned up"""
         try:
-            if hasattr(self, 'supabase') and hasattr(self.supabase, 'client'):
+            if hasattr(self, "supabase") and hasattr(self.supabase, "client"):
                 self.supabase.client.close()
         except:
             pass
@@ -88,10 +133,12 @@ class SupabaseClient:
     def authenticate_with_tokens(self, access_token: str) -> User:
         try:
             if not self.supabase_url or not self.supabase_service_key:
-                raise Exception("Supabase URL or key not found in environment variables")
+                raise Exception(
+                    "Supabase URL or key not found in environment variables"
+                )
 
             temp_supabase = create_client(self.supabase_url, self.supabase_service_key)
-            
+
             # Decode and verify the JWT token
             decoded = temp_supabase.auth.get_user(access_token)
             if decoded and decoded.user:
@@ -100,7 +147,7 @@ class SupabaseClient:
 
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Failed to authenticate"
+                detail="Failed to authenticate",
             )
 
         except Exception as exc:
@@ -276,6 +323,39 @@ class SupabaseClient:
                 detail=f"Failed to get chats for user {self.user_id}: {exc}",
             )
 
+    def fetch_chats_page(
+        self,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort: str = "updated_at",
+        desc: bool = True,
+        statuses: Optional[List[str]] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[List[Union[Chat, Dict]], Optional[str]]:
+        """Fetch one page of the chats of the user, and the cursor of the next page.
+
+        Chats are returned as plain dicts when fields are selected, since they may miss
+        fields required by Chat.
+        """
+        try:
+            query = (
+                self.supabase.table("chats")
+                .select(select_columns(fields, sort))
+                .eq("user_id", self.user_id)
+            )
+            if statuses:
+                query = query.in_("status", statuses)
+            rows, next_cursor = paginate(query, sort, desc, cursor, limit)
+            if fields is not None:
+                return rows, next_cursor
+            return [Chat(**item) for item in rows], next_cursor
+        except Exception as exc:
+            logger.error(f"An error occurred: {exc}")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed to get chats for user {self.user_id}: {exc}",
+            )
+
     def fetch_chat(self, chat_id: str) -> Chat:
         try:
             response = (
@@ -352,6 +432,39 @@ class SupabaseClient:
                 detail=f"Failed fetching tools: {exc}",
             )
 
+    def fetch_tools_page(
+        self,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort: str = "updated_at",
+        desc: bool = True,
+        is_public: Optional[bool] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """Fetch one page of the tools visible to the user, i.e. their own and the public
+        ones, and the cursor of the next page.
+
+        Args:
+            is_public: Only fetch public tools if True, only the user's private ones if False
+        """
+        try:
+            query = self.supabase.table("tools").select(select_columns(fields, sort))
+            match_any = None
+            if is_public is None:
+                match_any = f"user_id.eq.{self.user_id},is_public.eq.true"
+            elif is_public:
+                query = query.eq("is_public", True)
+            else:
+                # Tools created before is_public existed have it unset
+                query = query.eq("user_id", self.user_id).not_.is_("is_public", "true")
+            return paginate(query, sort, desc, cursor, limit, match_any=match_any)
+        except Exception as exc:
+            logger.error(f"An error occurred: {exc}")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed fetching tools: {exc}",
+            )
+
     def create_tool(self, tool_to_create: Tool) -> Tool:
         try:
             tool_data = tool_to_create.model_dump(exclude={"id"})
@@ -397,13 +510,20 @@ class SupabaseClient:
         tool_id = tool_data.pop("id")
         if not tool_id:
             raise Exception("Invalid tool_id")
+        # The service key bypasses the row level security, only the owner may update
         response = (
-            self.supabase.table("tools").update(tool_data).eq("id", tool_id).execute()
+            self.supabase.table("tools")
+            .update(tool_data)
+            .eq("id", tool_id)
+            .eq("user_id", self.user_id)
+            .execute()
         )
         if response.data:
             return response.data[0]
         else:
-            raise Exception("Tool not found")
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Tool not found"
+            )
 
     def delete_tool(self, tool_id: str) -> Dict:
         response = (
@@ -418,18 +538,42 @@ class SupabaseClient:
         else:
             raise Exception(f"Error deleting tool {tool_id}")
 
-    def fetch_messages(self, chat_id: str) -> List[Message]:
+    def fetch_messages(
+        self,
+        chat_id: str,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+    ) -> List[Union[Message, Dict]]:
+        """Fetch the messages of a chat in the order they were added.
+
+        Args:
+            chat_id: The chat to fetch the messages of
+            after_id: Only fetch messages with a greater id, i.e. added after this one
+            limit: Maximum number of messages to fetch
+            fields: Columns to fetch, the id is always included. Messages are returned
+                as plain dicts when set, since they may miss fields required by Message.
+        """
         try:
-            response = (
+            columns = (
+                "*" if fields is None else ",".join(dict.fromkeys(["id", *fields]))
+            )
+            query = (
                 self.supabase.table("chat_messages")
-                .select("*")
+                .select(columns)
                 .eq("chat_id", int(chat_id))
-                .execute()
             )
-            if response.data:
-                return [Message(**item) for item in response.data]
-            else:
+            if after_id is not None:
+                query = query.gt("id", after_id)
+            query = query.order("id")
+            if limit is not None:
+                query = query.limit(limit)
+            response = query.execute()
+            if not response.data:
                 return []
+            if fields is not None:
+                return response.data
+            return [Message(**item) for item in response.data]
         except Exception as exc:
             logger.error(f"An error occurred: {exc}")
             raise HTTPException(
@@ -443,7 +587,6 @@ class SupabaseClient:
             message_dict = message.model_dump(exclude={"id"})
             message_dict["user_id"] = self.user_id
             message_dict["chat_id"] = int(chat_id)
-            print(colored(f"Adding message: {message_dict}", "green"))
             response = (
                 self.supabase.table("chat_messages").insert(message_dict).execute()
             )
@@ -462,10 +605,10 @@ class SupabaseClient:
 
     async def add_log(self, log: LogCreate):
         """Add a log entry to the database.
-        
+
         Args:
             log: The log entry to add
-            
+
         Returns:
             dict: The raw response data from the database, or None if the operation failed
         """
@@ -475,26 +618,44 @@ class SupabaseClient:
                 "message": log.message,
                 "level": log.level,
                 "metadata": log.metadata,
-                "chat_id": int(log.chat_id) if isinstance(log.chat_id, str) else log.chat_id
+                "chat_id": (
+                    int(log.chat_id) if isinstance(log.chat_id, str) else log.chat_id
+                ),
             }
-            
+
             # Use asyncio.to_thread since supabase-py doesn't have async support
             response = await asyncio.to_thread(
                 lambda: self.supabase.table("chat_logs").insert(log_data).execute()
             )
-            
+
             if response and response.data:
-                print(colored(f"Added log for chat {log_data['chat_id']}", "green"))
                 return response.data[0]
-            
+
             print(colored(f"No response data from log insertion", "yellow"))
             return None
-            
+
         except Exception as exc:
             logger.error(f"Failed to add log: {exc}")
             logger.error(f"Attempted log data: {log_data}")
             return None
 
+    def fetch_logs(self, chat_id: str) -> List[Dict]:
+        try:
+            response = (
+                self.supabase.table("chat_logs")
+                .select("*")
+                .eq("chat_id", int(chat_id))
+                .order("id")
+                .execute()
+            )
+            return response.data or []
+        except Exception as exc:
+            logger.error(f"An error occurred: {exc}")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed fetching logs: {exc}",
+            )
+
     def fetch_source_metadata(self, chat_id: str) -> Dict:
         try:
             response = (
@@ -538,13 +699,14 @@ class SupabaseClient:
         chat_status: Literal[
             "ready", "running", "wait_for_human_input", "completed", "aborted", "failed"
         ],
+        user_id: Optional[str] = None,
     ):
         try:
             response = (
                 self.supabase.table("chats")
                 .update({"status": chat_status})
                 .eq("id", chat_id)
-                .eq("user_id", self.user_id)
+                .eq("user_id", user_id or self.user_id)
                 .execute()
             )
             if response.data:
@@ -557,41 +719,262 @@ class SupabaseClient:
                 detail=f"Failed to set chat status: {exc}",
             )
 
-    def upload_image(self, iamge_path, image_data):
+    def upload_image(self, image_data: bytes, extension: str = "png") -> str:
+        """Store an image in the `assets` bucket and return its public URL.
+
+        Images are named after the hash of their content, so an image already uploaded isn't
+        uploaded again: it costs no request if this process uploaded it, and a single
+        rejected one otherwise.
+        """
+        image_path = f"images/{hashlib.sha256(image_data).hexdigest()}.{extension}"
+        bucket = self.supabase.storage.from_("assets")
+        with self._uploaded_images_lock:
+            uploaded = image_path in self._uploaded_images
+            if uploaded:
+                self._uploaded_images.move_to_end(image_path)
+        if not uploaded:
+            # Not under the lock, a concurrent upload of the same image is only rejected
+            try:
+                bucket.upload(
+                    image_path,
+                    image_data,
+                    {
+                        "content-type": f"image/{extension}",
+                        # The content of a path never changes
+                        "cache-control": "31536000",
+                        "upsert": "false",
+                    },
+                )
+                print(colored(f"Uploaded image: {image_path}", "green"))
+            except StorageException as exc:
+                if not _is_duplicate(exc):
+                    logger.error(f"An error occurred during uploading image: {exc}")
+                    raise
+            with self._uploaded_images_lock:
+                self._uploaded_images[image_path] = None
+                if len(self._uploaded_images) > UPLOADED_IMAGES_CACHE_SIZE:
+                    self._uploaded_images.popitem(last=False)
+        return bucket.get_public_url(image_path)
+
+    def fetch_document(self, document_id: int) -> Dict:
         try:
-            if not iamge_path:
-                raise HTTPException(status_code=400, detail="Invalid iamge_path")
-            print(colored(f"Uploading document to dataset {iamge_path}", "light_blue"))
-            # Read the file content
-            file_extension = iamge_path.split(".")[-1]
-            # Check if the file already exists
-            existing_files = self.supabase.storage.from_("documents").list(
-                path=iamge_path
-            )
-            # TODO: This can be optimized to avoid multiple uploads of the same file
-            if any(file["name"] == iamge_path for file in existing_files):
-                # Delete the existing file
-                print(colored(f"Deleting existing document: {iamge_path}", "yellow"))
-                self.supabase.storage.from_("documents").remove([iamge_path])
-            res = self.supabase.storage.from_("assets").upload(iamge_path, image_data)
-            print(colored(f"Uploaded document: {iamge_path}", "green"))
-            return res
-        except Exception as e:
-            logger.error(f"An error occurred during uploading document: {e}")
-            raise
+            response = (
+                self.supabase.table("documents")
+                .select("*")
+                .eq("id", document_id)
+                .eq("user_id", self.user_id)
+                .execute()
+            )
+        except Exception as exc:
+            logger.error(f"An error occurred: {exc}")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed fetching document: {exc}",
+            )
+        if not response.data:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Document not found"
+            )
+        return response.data[0]
 
-    def search_chunks(self, dataset_id, query_vector, top_k):
-        result = self.supabase.rpc(
-            "search_chunks_by_dataset",
-            {
-                "p_dataset_id": dataset_id,
-                "p_query_vector": query_vector,
-                "p_limit": top_k,
-            },
+    def fetch_documents_by_status(self, document_status: str) -> List[Dict]:
+        response = (
+            self.supabase.table("documents")
+            .select("*")
+            .eq("status", document_status)
+            .execute()
+        )
+        return response.data or []
+
+    def claim_document(
+        self,
+        document_id: int,
+        expected_status: Optional[str],
+        stale_before: Optional[str] = None,
+        values: Optional[Dict] = None,
+    ) -> bool:
+        """Mark a document as processing, unless another worker did it first.
+
+        The update only applies if the document still has the expected status and, when
+        stale_before is set, wasn't updated since then, so only one worker wins.
+        """
+        query = (
+            self.supabase.table("documents")
+            .update({**(values or {}), "status": "processing", "updated_at": _now()})
+            .eq("id", document_id)
+        )
+        if expected_status is None:
+            query = query.is_("status", "null")
+        else:
+            query = query.eq("status", expected_status)
+        if stale_before is not None:
+            query = query.lt("updated_at", stale_before)
+        return bool(query.execute().data)
+
+    def update_document(self, document_id: int, values: Dict):
+        self.supabase.table("documents").update({**values, "updated_at": _now()}).eq(
+            "id", document_id
+        ).execute()
+
+    def download_document(self, path: str) -> bytes:
+        return self.supabase.storage.from_("documents").download(path)
+
+    def fetch_chunk_hashes(self, document_id: int) -> List[Dict]:
+        """Id, index, content hash and state of every chunk of a document, disabled ones included."""
+        chunks: List[Dict] = []
+        while True:
+            query = (
+                self.supabase.table("chunks")
+                .select("id,chunk_index,content_hash,enabled")
+                .eq("document_id", document_id)
+                .order("id")
+                .limit(CHUNK_PAGE_SIZE)
+            )
+            if chunks:
+                query = query.gt("id", chunks[-1]["id"])
+            page = query.execute().data or []
+            chunks.extend(page)
+            if len(page) < CHUNK_PAGE_SIZE:
+                return chunks
+
+    def insert_chunks(self, rows: List[Dict]):
+        self.supabase.table("chunks").insert(
+            rows, returning=ReturnMethod.minimal
+        ).execute()
+
+    def move_chunks(self, document_id: int, moves: List[Dict]):
+        """Set the index of existing chunks, given as `{"id", "chunk_index"}`, and enable them."""
+        self.supabase.rpc(
+            "move_chunks", {"p_document_id": document_id, "p_moves": moves}
         ).execute()
-        print("search_chunks", result)
+
+    def disable_chunks(self, chunk_ids: List[int]):
+        # Ids are sent in the query string, a few hundred at a time
+        for start in range(0, len(chunk_ids), CHUNK_PAGE_SIZE // 2):
+            self.supabase.table("chunks").update(
+                {"enabled": False}, returning=ReturnMethod.minimal
+            ).in_("id", chunk_ids[start : start + CHUNK_PAGE_SIZE // 2]).execute()
+
+    def search_chunks(
+        self, dataset_id, query_vector, top_k, ef_search: Optional[int] = HNSW_EF_SEARCH
+    ):
+        params = {
+            "p_dataset_id": dataset_id,
+            "p_query_vector": query_vector,
+            "p_limit": top_k,
+        }
+        if ef_search is not None:
+            params["p_ef_search"] = ef_search
+        result = self.supabase.rpc("search_chunks_by_dataset", params).execute()
         return result.data
 
+    def search_chunks_multi(
+        self,
+        dataset_ids: List[int],
+        query_vector,
+        top_k: int,
+        ef_search: Optional[int] = HNSW_EF_SEARCH,
+    ) -> List[Dict]:
+        """Search several datasets at once.
+
+        The chunks are merged by similarity, the same content found in several datasets is
+        only returned once, and top_k applies to the merged results.
+        """
+        dataset_ids = list(dict.fromkeys(int(dataset_id) for dataset_id in dataset_ids))
+        if not dataset_ids:
+            return []
+        params = {
+            "p_dataset_ids": dataset_ids,
+            "p_query_vector": query_vector,
+            "p_limit": top_k,
+        }
+        if ef_search is not None:
+            params["p_ef_search"] = ef_search
+        try:
+            result = self.supabase.rpc("search_chunks_by_datasets", params).execute()
+            return result.data
+        except APIError as exc:
+            # PGRST202: the function doesn't exist, the database is not migrated yet
+            if exc.code != "PGRST202":
+                raise
+            print(
+                colored(
+                    "search_chunks_by_datasets is missing, searching each dataset",
+                    "yellow",
+                )
+            )
+
+        with ThreadPoolExecutor(
+            max_workers=min(len(dataset_ids), SEARCH_WORKERS)
+        ) as executor:
+            results = executor.map(
+                lambda dataset_id: [
+                    {**chunk, "dataset_id": dataset_id}
+                    for chunk in self.search_chunks(
+                        dataset_id, query_vector, top_k, ef_search
+                    )
+                ],
+                dataset_ids,
+            )
+            return merge_chunks(results, top_k)
+
+    def search_chunks_lexical(
+        self, dataset_ids: List[int], query: str, top_k: int
+    ) -> List[Dict]:
+        """Full-text search of several datasets, by decreasing rank."""
+        result = self.supabase.rpc(
+            "search_chunks_lexical",
+            {"p_dataset_ids": dataset_ids, "p_query": query, "p_limit": top_k},
+        ).execute()
+        return result.data or []
+
+    def fetch_dataset_ids(self, dataset_ids: List[int]) -> List[int]:
+        """Ids of the given datasets which belong to the user."""
+        try:
+            response = (
+                self.supabase.table("datasets")
+                .select("id")
+                .in_("id", dataset_ids)
+                .eq("user_id", self.user_id)
+                .execute()
+            )
+        except Exception as exc:
+            logger.error(f"An error occurred: {exc}")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed fetching datasets: {exc}",
+            )
+        return [row["id"] for row in response.data or []]
+
+
+def _is_duplicate(exc: Exception) -> bool:
+    # Newer storage clients set the status, older ones pass the response as argument
+    status_code = getattr(exc, "status", None)
+    if status_code is None and exc.args and isinstance(exc.args[0], dict):
+        status_code = exc.args[0].get("statusCode")
+    return str(status_code) == "409" or "Duplicate" in str(exc)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def merge_chunks(results: Iterable[List[Dict]], top_k: int) -> List[Dict]:
+    """Merge chunks found in several searches, keeping the top_k most similar distinct ones."""
+    merged = {}
+    for chunk in heapq.merge(
+        *(sorted(chunks, key=lambda c: -c["similarity"]) for chunks in results),
+        key=lambda c: -c["similarity"],
+    ):
+        # Chunks come in order of similarity, so the first one of each content is the best
+        key = hashlib.md5(chunk["content"].encode("utf-8")).digest()
+        if key not in merged:
+            chunk.pop("embedding", None)
+            merged[key] = chunk
+            if len(merged) == top_k:
+                break
+    return list(merged.values())
+
 
 def create_supabase_client():
     return SupabaseClient()
@@ -1,21 +1,57 @@
-from ..models import Tool
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from ..models import Tool, ToolCreate
 from .supabase import SupabaseClient
 
+# Columns of the tools table which can be selected when listing tools
+TOOL_FIELDS = {
+    "id",
+    "name",
+    "description",
+    "logo_url",
+    "code",
+    "variables",
+    "user_id",
+    "is_public",
+    "created_at",
+    "updated_at",
+}
+
+
 class ToolService:
-    def __init__(self,  supabase: SupabaseClient):
+    def __init__(self, supabase: SupabaseClient):
         self.supabase = supabase
 
-    def get_all_tools(self):
-        return self.tool_repository.get_all_tools()
+    async def get_tools(
+        self,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort: str = "updated_at",
+        desc: bool = True,
+        is_public: Optional[bool] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        if fields is not None and not set(fields) <= TOOL_FIELDS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown tool fields: {', '.join(sorted(set(fields) - TOOL_FIELDS))}",
+            )
+        return self.supabase.fetch_tools_page(
+            cursor, limit, sort, desc, is_public, fields
+        )
 
-    def get_tool_by_id(self, tool_id: int):
-        return self.tool_repository.get_tool_by_id(tool_id)
+    async def get_tool(self, tool_id: str) -> Tool:
+        return self.supabase.fetch_tool(tool_id)
 
-    def create_tool(self, tool: Tool):
-        return self.tool_repository.create_tool(tool)
+    async def create_tool(self, tool: ToolCreate) -> Tool:
+        return self.supabase.create_tool(tool)
 
-    def update_tool(self, tool: Tool):
-        return self.tool_repository.update_tool(tool)
+    async def update_tool(self, tool_id: str, tool: ToolCreate) -> Tool:
+        return self.supabase.update_tool(
+            Tool(id=int(tool_id), user_id=self.supabase.user_id, **tool.model_dump())
+        )
 
-    def delete_tool(self, tool_id: int):
-        return self.tool_repository.delete_tool(tool_id)
\ No newline at end of file
+    async def delete_tool(self, tool_id: str) -> Dict:
+        return self.supabase.delete_tool(tool_id)
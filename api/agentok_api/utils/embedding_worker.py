@@ -0,0 +1,23 @@
+"""Embedding functions run in worker processes during document ingestion.
+
+Kept apart from the services, so spawning a worker only imports this module and
+sentence-transformers, not the whole API.
+"""
+
+from typing import List
+
+_model = None
+_model_name = None
+
+
+def embed_texts(model_name: str, texts: List[str]) -> List[List[float]]:
+    global _model, _model_name
+    if _model is None or _model_name != model_name:
+        from sentence_transformers import SentenceTransformer
+
+        # Loaded once per worker process, then reused for every batch
+        _model = SentenceTransformer(model_name)
+        _model_name = model_name
+    return _model.encode(
+        texts, batch_size=len(texts), normalize_embeddings=True
+    ).tolist()
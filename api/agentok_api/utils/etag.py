@@ -0,0 +1,34 @@
+import hashlib
+import json
+from typing import Any
+
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, proxies may have turned our tag into a weak one
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags
+
+
+def etag_response(request: Request, content: Any) -> Response:
+    """Serialize content to JSON with an ETag, or answer 304 if the client already has it."""
+    body = json.dumps(
+        jsonable_encoder(content), separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+    etag = make_etag(body)
+    # Clients may keep the response, as long as they revalidate it
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
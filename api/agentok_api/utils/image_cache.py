@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from diskcache import Cache
+
+# Kept apart from the other caches, so it can be sized and cleared on its own. Absolute, as
+# the chat processes share it with the API.
+IMAGE_CACHE_DIR = os.path.abspath(
+    os.environ.get("AGENTOK_IMAGE_CACHE_DIR") or os.path.join(".cache", "images")
+)
+# Least recently used images are evicted beyond this size
+IMAGE_CACHE_SIZE_LIMIT = 512 * 1024 * 1024
+# Seconds an image is kept, even if it's used
+IMAGE_CACHE_TTL = 30 * 24 * 60 * 60
+
+_cache: Optional[Cache] = None
+_cache_lock = threading.Lock()
+
+# Seconds a generation may hold its lock, in case the process holding it dies
+GENERATION_LOCK_TTL = 5 * 60
+# Seconds to wait for an identical generation, the image is then created regardless
+LOCK_WAIT_TIMEOUT = 60
+# Seconds between two checks of a lock held by another generation, doubled each time
+LOCK_POLL_INTERVAL = 0.05
+LOCK_POLL_MAX_INTERVAL = 1.0
+
+# Counters are kept in the cache, the images are created in the chat processes
+STATS = ("hits", "misses", "coalesced")
+
+
+def get_image_cache() -> Cache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = Cache(
+                IMAGE_CACHE_DIR,
+                size_limit=IMAGE_CACHE_SIZE_LIMIT,
+                eviction_policy="least-recently-used",
+            )
+        return _cache
+
+
+def _normalize(value: Any) -> Any:
+    # Prompts differing only by spacing give the same image
+    if isinstance(value, str):
+        return " ".join(value.split())
+    return value
+
+
+def image_cache_key(namespace: str, **params) -> str:
+    """Key of an image in the cache, the hash of its normalized parameters."""
+    normalized = {name: _normalize(value) for name, value in params.items()}
+    raw = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+    return f"{namespace}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+
+def _count(stat: str):
+    get_image_cache().incr(f"stats:{stat}", retry=True)
+
+
+def get_or_create_image(
+    key: str, create: Callable[[], Optional[bytes]]
+) -> Optional[bytes]:
+    """Return the cached image, or create and cache it.
+
+    Concurrent calls with the same key, in any process using the cache, create the image
+    once, the others wait for it, up to LOCK_WAIT_TIMEOUT. Images which fail to be
+    created (None) are not cached.
+    """
+    cache = get_image_cache()
+    data = cache.get(key)
+    if data is not None:
+        _count("hits")
+        return data
+
+    lock_key = f"lock:{key}"
+    # Only the holder of the lock may release it, it may have expired and been taken by
+    # another generation in the meantime
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + LOCK_WAIT_TIMEOUT
+    interval = LOCK_POLL_INTERVAL
+    # The first process to add the lock creates the image
+    locked = cache.add(lock_key, token, expire=GENERATION_LOCK_TTL, retry=True)
+    while not locked and time.monotonic() < deadline:
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        interval = min(interval * 2, LOCK_POLL_MAX_INTERVAL)
+        data = cache.get(key)
+        if data is not None:
+            _count("coalesced")
+            return data
+        locked = cache.add(lock_key, token, expire=GENERATION_LOCK_TTL, retry=True)
+    try:
+        data = cache.get(key)
+        if data is not None:
+            _count("coalesced")
+            return data
+        _count("misses")
+        data = create()
+        if data is not None:
+            cache.set(key, data, expire=IMAGE_CACHE_TTL)
+        return data
+    finally:
+        if locked:
+            with cache.transact(retry=True):
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+
+
+def image_cache_stats() -> Dict[str, int]:
+    """Hits, misses and waits for an identical request, of every process, and cache usage."""
+    cache = get_image_cache()
+    stats = {stat: cache.get(f"stats:{stat}") for stat in STATS}
+    return {
+        **{stat: value or 0 for stat, value in stats.items()},
+        # The counters are entries too
+        "entries": len(cache) - sum(value is not None for value in stats.values()),
+        "volume_bytes": cache.volume(),
+        "size_limit_bytes": IMAGE_CACHE_SIZE_LIMIT,
+    }
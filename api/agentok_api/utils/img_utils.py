@@ -1,10 +1,68 @@
 import base64
+import hashlib
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
-from typing import List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import requests
-from PIL import Image
+from PIL import Image, ImageOps
+
+from .image_cache import get_or_create_image, image_cache_key
+
+# Seconds to connect and to wait for data when fetching an image
+IMAGE_FETCH_TIMEOUT = (5, 30)
+
+# Images of a prompt loaded at once
+IMAGE_LOAD_WORKERS = 8
+# Images fetched from a URL kept in memory, prompts often repeat the images of earlier messages
+IMAGE_URL_CACHE_SIZE = 64
+
+# Images sent to vision models are downscaled so their longest side is at most this many
+# pixels, and recompressed. Left as is when unset.
+IMAGE_MAX_SIDE = (
+    int(os.environ["AGENTOK_IMAGE_MAX_SIDE"])
+    if os.environ.get("AGENTOK_IMAGE_MAX_SIDE")
+    else None
+)
+# Formats the images can be recompressed to, and their other names
+IMAGE_FORMATS = ("jpeg", "webp")
+IMAGE_FORMAT_ALIASES = {"jpg": "jpeg"}
+
+
+def _image_format(value: str) -> str:
+    image_format = value.strip().lower()
+    image_format = IMAGE_FORMAT_ALIASES.get(image_format, image_format)
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(
+            f"Unsupported AGENTOK_IMAGE_FORMAT {value!r}, "
+            f"expected one of {', '.join(IMAGE_FORMATS)}"
+        )
+    return image_format
+
+
+# Format of the recompressed images, checked at import rather than on the first image
+IMAGE_FORMAT = _image_format(os.environ.get("AGENTOK_IMAGE_FORMAT") or "jpeg")
+IMAGE_QUALITY = int(os.environ.get("AGENTOK_IMAGE_QUALITY") or 85)
+
+# Regular expression pattern for matching <img ...> tags
+IMG_TAG_PATTERN = re.compile(r"<img ([^>]+)>")
+
+# Shared by the fetches, so connections to the same host are reused
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+
+@lru_cache(maxsize=IMAGE_URL_CACHE_SIZE)
+def fetch_image(url: str) -> bytes:
+    # Failed fetches raise, so they aren't cached
+    response = _session.get(url, timeout=IMAGE_FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.content
 
 
 def get_image_data(image_file: str, use_b64=True) -> bytes:
@@ -19,10 +77,11 @@ def get_image_data(image_file: str, use_b64=True) -> bytes:
         bytes: The image data, either as raw bytes or base64-encoded string.
     """
     if image_file.startswith("http://") or image_file.startswith("https://"):
-        response = requests.get(image_file)
-        content = response.content
+        content = fetch_image(image_file)
     elif re.match(r"^data:image/(png|jpeg);base64,", image_file):
-        content = base64.b64decode(re.sub(r"^data:image/(png|jpeg);base64,", "", image_file))
+        content = base64.b64decode(
+            re.sub(r"^data:image/(png|jpeg);base64,", "", image_file)
+        )
     else:
         image = Image.open(image_file).convert("RGB")
         buffered = BytesIO()
@@ -35,7 +94,96 @@ def get_image_data(image_file: str, use_b64=True) -> bytes:
         return content
 
 
-def llava_formater(prompt: str, order_image_tokens: bool = False) -> Tuple[str, List[str]]:
+def normalize_image(
+    image_data: bytes,
+    max_side: int,
+    image_format: str = IMAGE_FORMAT,
+    quality: int = IMAGE_QUALITY,
+) -> bytes:
+    """Downscale an image to fit in max_side and recompress it, without its metadata."""
+    image = Image.open(BytesIO(image_data))
+    # The orientation is part of the metadata, apply it before dropping it
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if image_format == "jpeg" and image.mode != "RGB":
+        # JPEG has no transparency, flatten on white
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    buffered = BytesIO()
+    image.save(buffered, format=image_format.upper(), quality=quality, optimize=True)
+    return buffered.getvalue()
+
+
+def normalize_image_cached(
+    image_data: bytes,
+    max_side: int,
+    image_format: str = IMAGE_FORMAT,
+    quality: int = IMAGE_QUALITY,
+) -> bytes:
+    """normalize_image, cached by the hash of the source image and the settings."""
+    key = image_cache_key(
+        "normalized",
+        source=hashlib.sha256(image_data).hexdigest(),
+        max_side=max_side,
+        format=image_format,
+        quality=quality,
+    )
+    return get_or_create_image(
+        key, lambda: normalize_image(image_data, max_side, image_format, quality)
+    )
+
+
+def _load_image(image_location: str) -> bytes:
+    if IMAGE_MAX_SIDE is None:
+        return get_image_data(image_location, use_b64=False)
+    if os.path.isfile(image_location):
+        # No need to convert the file to PNG first, it's recompressed anyway
+        with open(image_location, "rb") as f:
+            image_data = f.read()
+    else:
+        image_data = get_image_data(image_location, use_b64=False)
+    return normalize_image_cached(image_data, IMAGE_MAX_SIDE)
+
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=IMAGE_LOAD_WORKERS, thread_name_prefix="image-loader"
+            )
+        return _pool
+
+
+def load_images(image_locations: List[str]) -> Dict[str, Union[bytes, Exception]]:
+    """Load the raw data of several images concurrently, normalized if IMAGE_MAX_SIDE is set.
+
+    Returns the data of each distinct location, or the exception raised while loading it.
+    """
+    locations = list(dict.fromkeys(image_locations))
+    futures = {
+        location: _get_pool().submit(_load_image, location) for location in locations
+    }
+    images = {}
+    for location, future in futures.items():
+        try:
+            images[location] = future.result()
+        except Exception as e:
+            images[location] = e
+    return images
+
+
+def llava_formater(
+    prompt: str, order_image_tokens: bool = False
+) -> Tuple[str, List[str]]:
     """
     Formats the input prompt by replacing image tags and returns the new prompt along with image locations.
 
@@ -48,55 +196,57 @@ def llava_formater(prompt: str, order_image_tokens: bool = False) -> Tuple[str,
         - Tuple[str, List[str]]: A tuple containing the formatted string and a list of images (loaded in b64 format).
     """
 
-    # Initialize variables
-    new_prompt = prompt
-    image_locations = []
-    images = []
-    image_count = 0
+    matches = list(IMG_TAG_PATTERN.finditer(prompt))
+    loaded = load_images([match.group(1) for match in matches])
 
-    # Regular expression pattern for matching <img ...> tags
-    img_tag_pattern = re.compile(r"<img ([^>]+)>")
-
-    # Find all image tags
-    for match in img_tag_pattern.finditer(prompt):
+    # The prompt is assembled from its parts in a single pass
+    parts = []
+    images = []
+    last_index = 0
+    for match in matches:
         image_location = match.group(1)
+        parts.append(prompt[last_index : match.start()])
+        last_index = match.end()
 
-        try:
-            img_data = get_image_data(image_location)
-        except Exception as e:
+        img_data = loaded[image_location]
+        if isinstance(img_data, Exception):
             # Remove the token
-            print(f"Warning! Unable to load image from {image_location}, because of {e}")
-            new_prompt = new_prompt.replace(match.group(0), "", 1)
+            print(
+                f"Warning! Unable to load image from {image_location}, because of {img_data}"
+            )
             continue
 
-        image_locations.append(image_location)
-        images.append(img_data)
+        images.append(base64.b64encode(img_data))
+        # Number the tokens in the order of the images
+        parts.append(f"<image {len(images) - 1}>" if order_image_tokens else "<image>")
+    parts.append(prompt[last_index:])
+
+    return "".join(parts), images
 
-        # Increment the image count and replace the tag in the prompt
-        new_token = f"<image {image_count}>" if order_image_tokens else "<image>"
 
-        new_prompt = new_prompt.replace(match.group(0), new_token, 1)
-        image_count += 1
+def _get_mime_type(image_data: bytes) -> str:
+    # Check the first few bytes for known signatures
+    if image_data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    elif image_data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    elif image_data.startswith(b"GIF87a") or image_data.startswith(b"GIF89a"):
+        return "image/gif"
+    elif image_data.startswith(b"RIFF") and image_data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"  # use jpeg for unknown formats, best guess.
 
-    return new_prompt, images
 
+def image_data_uri(image_data: bytes) -> str:
+    """Encode raw image data as a data URI, the only place it needs base64."""
+    return f"data:{_get_mime_type(image_data)};base64,{base64.b64encode(image_data).decode('ascii')}"
 
-def convert_base64_to_data_uri(base64_image):
-    def _get_mime_type_from_data_uri(base64_image):
-        # Decode the base64 string
-        image_data = base64.b64decode(base64_image)
-        # Check the first few bytes for known signatures
-        if image_data.startswith(b"\xff\xd8\xff"):
-            return "image/jpeg"
-        elif image_data.startswith(b"\x89PNG\r\n\x1a\n"):
-            return "image/png"
-        elif image_data.startswith(b"GIF87a") or image_data.startswith(b"GIF89a"):
-            return "image/gif"
-        elif image_data.startswith(b"RIFF") and image_data[8:12] == b"WEBP":
-            return "image/webp"
-        return "image/jpeg"  # use jpeg for unknown formats, best guess.
 
-    mime_type = _get_mime_type_from_data_uri(base64_image)
+def convert_base64_to_data_uri(base64_image: Union[str, bytes]) -> str:
+    if isinstance(base64_image, bytes):
+        base64_image = base64_image.decode("ascii")
+    # Only the first bytes are needed to find the type
+    mime_type = _get_mime_type(base64.b64decode(base64_image[:64]))
     data_uri = f"data:{mime_type};base64,{base64_image}"
     return data_uri
 
@@ -113,30 +263,30 @@ def gpt4v_formatter(prompt: str) -> List[Union[str, dict]]:
     """
     output = []
     last_index = 0
-    image_count = 0
 
-    # Regular expression pattern for matching <img ...> tags
-    img_tag_pattern = re.compile(r"<img ([^>]+)>")
+    matches = list(IMG_TAG_PATTERN.finditer(prompt))
+    loaded = load_images([match.group(1) for match in matches])
 
-    # Find all image tags
-    for match in img_tag_pattern.finditer(prompt):
+    for match in matches:
         image_location = match.group(1)
 
-        try:
-            img_data = get_image_data(image_location)
-        except Exception as e:
+        img_data = loaded[image_location]
+        if isinstance(img_data, Exception):
             # Warning and skip this token
-            print(f"Warning! Unable to load image from {image_location}, because {e}")
+            print(
+                f"Warning! Unable to load image from {image_location}, because {img_data}"
+            )
             continue
 
         # Add text before this image tag to output list
         output.append({"type": "text", "text": prompt[last_index : match.start()]})
 
         # Add image data to output list
-        output.append({"type": "image_url", "image_url": {"url": convert_base64_to_data_uri(img_data)}})
+        output.append(
+            {"type": "image_url", "image_url": {"url": image_data_uri(img_data)}}
+        )
 
         last_index = match.end()
-        image_count += 1
 
     # Add remaining text to output list
     output.append({"type": "text", "text": prompt[last_index:]})
@@ -155,7 +305,8 @@ def extract_img_paths(paragraph: str) -> list:
     """
     # Regular expression to match image URLs and file paths
     img_path_pattern = re.compile(
-        r"\b(?:http[s]?://\S+\.(?:jpg|jpeg|png|gif|bmp)|\S+\.(?:jpg|jpeg|png|gif|bmp))\b", re.IGNORECASE
+        r"\b(?:http[s]?://\S+\.(?:jpg|jpeg|png|gif|bmp)|\S+\.(?:jpg|jpeg|png|gif|bmp))\b",
+        re.IGNORECASE,
     )
 
     # Find all matches in the paragraph
@@ -163,17 +314,18 @@ def extract_img_paths(paragraph: str) -> list:
     return img_paths
 
 
-def _to_pil(data: str) -> Image.Image:
+def _to_pil(data: Union[str, bytes]) -> Image.Image:
     """
-    Converts a base64 encoded image data string to a PIL Image object.
+    Converts image data to a PIL Image object.
 
-    This function first decodes the base64 encoded string to bytes, then creates a BytesIO object from the bytes,
-    and finally creates and returns a PIL Image object from the BytesIO object.
+    Raw image bytes are read as is, a string is taken as base64 encoded image data and decoded first.
 
     Parameters:
-        data (str): The base64 encoded image data string.
+        data (Union[str, bytes]): The raw image data, or the base64 encoded image data string.
 
     Returns:
         Image.Image: The PIL Image object created from the input data.
     """
-    return Image.open(BytesIO(base64.b64decode(data)))
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    return Image.open(BytesIO(data))
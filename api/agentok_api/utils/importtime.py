@@ -0,0 +1,48 @@
+from typing import Dict, List
+
+IMPORTTIME_PREFIX = "import time:"
+
+
+def is_importtime_line(line: str) -> bool:
+    return line.startswith(IMPORTTIME_PREFIX)
+
+
+def summarize_importtime(lines: List[str], top_n: int = 10) -> Dict:
+    """
+    Summarize the output of `python -X importtime`.
+
+    Each line looks like `import time:  self [us] | cumulative | imported package`, where
+    nested imports are indented below the package importing them.
+
+    Args:
+        lines (List[str]): The stderr lines written by the interpreter.
+        top_n (int): The number of slowest top-level imports to keep.
+
+    Returns:
+        Dict: The total import time and the slowest top-level imports, in microseconds.
+    """
+    top_level = []
+    for line in lines:
+        if not is_importtime_line(line):
+            continue
+        parts = line[len(IMPORTTIME_PREFIX) :].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            cumulative = int(parts[1].strip())
+        except ValueError:
+            # The header line: "self [us] | cumulative | imported package"
+            continue
+        name = parts[2].rstrip()
+        # Top-level imports are separated from the column by exactly one space
+        if len(name) - len(name.lstrip()) == 1:
+            top_level.append((name.strip(), cumulative))
+
+    top_level.sort(key=lambda item: item[1], reverse=True)
+    return {
+        "total_us": sum(cumulative for _, cumulative in top_level),
+        "top": [
+            {"module": module, "cumulative_us": cumulative}
+            for module, cumulative in top_level[:top_n]
+        ],
+    }
@@ -0,0 +1,93 @@
+import base64
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# Sort columns allowed for keyset pagination. They must be non-null, the id breaks ties.
+SORTABLE_COLUMNS = ("updated_at", "created_at", "id")
+
+# Upper bound of the page size when listing rows
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(row: Dict, sort: str) -> str:
+    """Opaque cursor pointing right after the given row."""
+    raw = json.dumps([row[sort], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    """Raises ValueError for cursors not made by encode_cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, row_id = json.loads(raw)
+        return value, int(row_id)
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor}") from exc
+
+
+def _quote(value: Any) -> str:
+    # Values in PostgREST logical filters are quoted, as timestamps may contain reserved characters
+    text = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{text}"'
+
+
+def keyset_filter(sort: str, desc: bool, cursor: str) -> str:
+    """PostgREST `or` filter selecting the rows after the cursor, in the given order."""
+    value, row_id = decode_cursor(cursor)
+    op = "lt" if desc else "gt"
+    if sort == "id":
+        return f"id.{op}.{row_id}"
+    return (
+        f"{sort}.{op}.{_quote(value)},and({sort}.eq.{_quote(value)},id.{op}.{row_id})"
+    )
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Split the comma-separated `fields` query parameter."""
+    if fields is None:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+def select_columns(fields: Optional[List[str]], sort: str) -> str:
+    """Columns to select, keeping the ones needed to build the next cursor."""
+    if fields is None:
+        return "*"
+    return ",".join(dict.fromkeys(["id", sort, *fields]))
+
+
+def paginate(
+    query,
+    sort: str,
+    desc: bool,
+    cursor: Optional[str],
+    limit: Optional[int],
+    match_any: Optional[str] = None,
+) -> Tuple[List[Dict], Optional[str]]:
+    """Run a select query one page at a time.
+
+    Returns the rows of the page and the cursor of the next one, which is None on the last
+    page. Without a limit every row after the cursor is returned.
+
+    PostgREST takes a single `or` filter per query, so a query which needs one of its own
+    passes it as `match_any` to be combined with the cursor.
+    """
+    filters = [match_any] if match_any else []
+    if cursor:
+        filters.append(keyset_filter(sort, desc, cursor))
+    if len(filters) == 1:
+        query = query.or_(filters[0])
+    elif filters:
+        query = query.or_(f"and({','.join(f'or({f})' for f in filters)})")
+    query = query.order(sort, desc=desc)
+    if sort != "id":
+        query = query.order("id", desc=desc)
+    if limit is not None:
+        # One extra row tells whether there's a next page
+        query = query.limit(limit + 1)
+
+    rows = query.execute().data or []
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1], sort)
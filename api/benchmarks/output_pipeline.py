@@ -0,0 +1,83 @@
+"""Throughput of the assistant output pipeline.
+
+Feeds synthetic autogen output through OutputPipeline with sinks that only count, or
+that simulate a database round trip with --sink-latency.
+
+Run from the api directory:
+
+    poetry run python -m benchmarks.output_pipeline --lines 100000
+"""
+
+import argparse
+import asyncio
+import time
+
+from agentok_api.services.output_parser import OutputParser
+from agentok_api.services.output_pipeline import OutputPipeline
+
+SAMPLE_OUTPUT = [
+    "user (to assistant):",
+    "",
+    "What is the share price of NVDA today?",
+    "",
+    "-" * 80,
+    "assistant (to user):",
+    "",
+    "***** Suggested tool call (call_1): get_share_price *****",
+    'Arguments: {"symbol": "NVDA"}',
+    "*" * 60,
+    "-" * 80,
+    "__STATUS_WAIT_FOR_HUMAN_INPUT__ Provide feedback to assistant:",
+    "__STATUS_RECEIVED_HUMAN_INPUT__ Provide feedback to assistant:",
+]
+
+
+async def run(lines: int, sink_latency: float) -> dict:
+    counts = {"log": 0, "message": 0, "status": 0}
+
+    def counting_sink(name):
+        async def sink(_):
+            counts[name] += 1
+            if sink_latency:
+                await asyncio.sleep(sink_latency)
+
+        return sink
+
+    pipeline = OutputPipeline(
+        OutputParser(),
+        log_sink=counting_sink("log"),
+        message_sink=counting_sink("message"),
+        status_sink=counting_sink("status"),
+        echo=False,
+    )
+
+    started = time.perf_counter()
+    for i in range(lines):
+        await pipeline.put(SAMPLE_OUTPUT[i % len(SAMPLE_OUTPUT)])
+    await pipeline.close()
+    elapsed = time.perf_counter() - started
+
+    return {"elapsed": elapsed, "lines_per_second": lines / elapsed, **counts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=100_000)
+    parser.add_argument(
+        "--sink-latency",
+        type=float,
+        default=0.0,
+        help="Seconds each sink call takes, to simulate database writes.",
+    )
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.lines, args.sink_latency))
+    print(
+        f"{args.lines} lines in {result['elapsed']:.2f}s "
+        f"({result['lines_per_second']:,.0f} lines/s): "
+        f"{result['log']} logs, {result['message']} messages, {result['status']} statuses"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+-- Messages of a chat are read in pages ordered by id, after the last id the client has
+CREATE INDEX IF NOT EXISTS "chat_messages_chat_id_id_idx" ON "public"."chat_messages" USING "btree" ("chat_id", "id");
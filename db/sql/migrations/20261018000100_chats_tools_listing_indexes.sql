@@ -0,0 +1,14 @@
+-- Chats and tools are listed by keyset pagination on (updated_at, id), which needs non-null sort keys
+UPDATE "public"."chats" SET "updated_at" = "created_at" WHERE "updated_at" IS NULL;
+ALTER TABLE "public"."chats" ALTER COLUMN "updated_at" SET NOT NULL;
+
+UPDATE "public"."tools" SET "updated_at" = "created_at" WHERE "updated_at" IS NULL;
+ALTER TABLE "public"."tools" ALTER COLUMN "updated_at" SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS "chats_user_id_updated_at_idx" ON "public"."chats" USING "btree" ("user_id", "updated_at" DESC, "id" DESC);
+
+CREATE INDEX IF NOT EXISTS "chats_user_id_created_at_idx" ON "public"."chats" USING "btree" ("user_id", "created_at" DESC, "id" DESC);
+
+CREATE INDEX IF NOT EXISTS "tools_user_id_updated_at_idx" ON "public"."tools" USING "btree" ("user_id", "updated_at" DESC, "id" DESC);
+
+CREATE INDEX IF NOT EXISTS "tools_public_updated_at_idx" ON "public"."tools" USING "btree" ("updated_at" DESC, "id" DESC) WHERE "is_public";
@@ -0,0 +1,46 @@
+-- Searches several datasets in one query, merged by similarity and deduplicated
+CREATE OR REPLACE FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer) RETURNS TABLE("id" bigint, "document_id" bigint, "dataset_id" bigint, "content" "text", "similarity" double precision)
+    LANGUAGE "plpgsql"
+    AS $$
+BEGIN
+    RETURN QUERY
+    WITH candidates AS (
+        -- Oversample, so there are enough chunks left once duplicates are dropped
+        SELECT
+            c.id,
+            c.document_id,
+            c.dataset_id,
+            c.content,
+            c.embedding <=> p_query_vector AS distance
+        FROM
+            chunks_with_dataset c
+        WHERE
+            c.dataset_id = ANY(p_dataset_ids)
+        ORDER BY
+            c.embedding <=> p_query_vector
+        LIMIT p_limit * 4
+    ), deduplicated AS (
+        -- The same content may be indexed in several datasets, keep its closest chunk
+        SELECT DISTINCT ON (md5(candidates.content)) *
+        FROM candidates
+        ORDER BY md5(candidates.content), candidates.distance
+    )
+    SELECT
+        deduplicated.id,
+        deduplicated.document_id,
+        deduplicated.dataset_id,
+        deduplicated.content,
+        1 - deduplicated.distance AS similarity
+    FROM
+        deduplicated
+    ORDER BY
+        deduplicated.distance
+    LIMIT p_limit;
+END;
+$$;
+
+ALTER FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer) OWNER TO "postgres";
+
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer) TO "anon";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer) TO "authenticated";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer) TO "service_role";
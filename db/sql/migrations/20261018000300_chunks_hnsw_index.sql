@@ -0,0 +1,146 @@
+-- Approximate nearest neighbour search on chunks, skipping disabled chunks and documents.
+--
+-- HNSW indexes need a fixed dimension. 384 is the dimension of the default embedding
+-- model (sentence-transformers/all-MiniLM-L6-v2), change it everywhere below if the chunks
+-- were embedded with another model. The ALTER fails if existing embeddings don't match.
+
+UPDATE "public"."chunks" SET "enabled" = true WHERE "enabled" IS NULL;
+ALTER TABLE "public"."chunks" ALTER COLUMN "enabled" SET NOT NULL;
+
+UPDATE "public"."documents" SET "enabled" = true WHERE "enabled" IS NULL;
+ALTER TABLE "public"."documents" ALTER COLUMN "enabled" SET NOT NULL;
+
+DROP VIEW IF EXISTS "public"."chunks_with_dataset";
+ALTER TABLE "public"."chunks" ALTER COLUMN "embedding" TYPE "public"."vector"(384);
+
+CREATE OR REPLACE VIEW "public"."chunks_with_dataset" AS
+ SELECT "c"."id",
+    "c"."created_at",
+    "c"."content",
+    "c"."embedding",
+    "c"."document_id",
+    "c"."chunk_index",
+    "d"."dataset_id",
+    "c"."enabled",
+    "d"."enabled" AS "document_enabled"
+   FROM ("public"."chunks" "c"
+     JOIN "public"."documents" "d" ON (("c"."document_id" = "d"."id")));
+
+ALTER TABLE "public"."chunks_with_dataset" OWNER TO "postgres";
+
+GRANT ALL ON TABLE "public"."chunks_with_dataset" TO "anon";
+GRANT ALL ON TABLE "public"."chunks_with_dataset" TO "authenticated";
+GRANT ALL ON TABLE "public"."chunks_with_dataset" TO "service_role";
+
+CREATE INDEX IF NOT EXISTS "chunks_document_id_idx" ON "public"."chunks" USING "btree" ("document_id");
+
+-- Building the index is much faster when it fits in memory, e.g. SET maintenance_work_mem = '2GB';
+CREATE INDEX IF NOT EXISTS "chunks_embedding_hnsw_idx" ON "public"."chunks" USING "hnsw" ("embedding" "public"."vector_cosine_ops") WITH ("m"='16', "ef_construction"='64');
+
+CREATE INDEX IF NOT EXISTS "documents_dataset_id_idx" ON "public"."documents" USING "btree" ("dataset_id");
+
+-- The functions take an extra argument, drop the old ones so calls are not ambiguous
+DROP FUNCTION IF EXISTS "public"."search_chunks_by_dataset"(integer, "public"."vector", integer);
+DROP FUNCTION IF EXISTS "public"."search_chunks_by_datasets"(bigint[], "public"."vector", integer);
+
+CREATE OR REPLACE FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer DEFAULT 40) RETURNS TABLE("id" bigint, "document_id" bigint, "content" "text", "embedding" "public"."vector", "similarity" double precision)
+    LANGUAGE "plpgsql"
+    AS $$
+BEGIN
+    -- Candidates visited by the HNSW index, the higher the better the recall and the slower
+    PERFORM set_config('hnsw.ef_search', LEAST(GREATEST(p_ef_search, p_limit), 1000)::text, true);
+    -- Keep scanning the index until enough chunks pass the filters. Only pgvector 0.8 and
+    -- later have this setting, older versions may return fewer chunks than asked for.
+    IF (SELECT string_to_array(extversion, '.')::int[] >= ARRAY[0, 8] FROM pg_extension WHERE extname = 'vector') THEN
+        PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    END IF;
+
+    RETURN QUERY
+    WITH nearest AS MATERIALIZED (
+        SELECT
+            c.id,
+            c.document_id,
+            c.content,
+            c.embedding,
+            c.embedding <=> p_query_vector AS distance
+        FROM
+            chunks_with_dataset c
+        WHERE
+            c.dataset_id = p_dataset_id
+            AND c.enabled
+            AND c.document_enabled
+        ORDER BY
+            c.embedding <=> p_query_vector
+        LIMIT p_limit
+    )
+    SELECT
+        nearest.id,
+        nearest.document_id,
+        nearest.content,
+        nearest.embedding,
+        1 - nearest.distance AS similarity
+    FROM
+        nearest
+    -- The iterative scan may return chunks slightly out of order
+    ORDER BY
+        nearest.distance;
+END;
+$$;
+
+ALTER FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) OWNER TO "postgres";
+
+CREATE OR REPLACE FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer DEFAULT 40) RETURNS TABLE("id" bigint, "document_id" bigint, "dataset_id" bigint, "content" "text", "similarity" double precision)
+    LANGUAGE "plpgsql"
+    AS $$
+BEGIN
+    PERFORM set_config('hnsw.ef_search', LEAST(GREATEST(p_ef_search, p_limit * 4), 1000)::text, true);
+    IF (SELECT string_to_array(extversion, '.')::int[] >= ARRAY[0, 8] FROM pg_extension WHERE extname = 'vector') THEN
+        PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    END IF;
+
+    RETURN QUERY
+    WITH candidates AS MATERIALIZED (
+        -- Oversample, so there are enough chunks left once duplicates are dropped
+        SELECT
+            c.id,
+            c.document_id,
+            c.dataset_id,
+            c.content,
+            c.embedding <=> p_query_vector AS distance
+        FROM
+            chunks_with_dataset c
+        WHERE
+            c.dataset_id = ANY(p_dataset_ids)
+            AND c.enabled
+            AND c.document_enabled
+        ORDER BY
+            c.embedding <=> p_query_vector
+        LIMIT p_limit * 4
+    ), deduplicated AS (
+        -- The same content may be indexed in several datasets, keep its closest chunk
+        SELECT DISTINCT ON (md5(candidates.content)) *
+        FROM candidates
+        ORDER BY md5(candidates.content), candidates.distance
+    )
+    SELECT
+        deduplicated.id,
+        deduplicated.document_id,
+        deduplicated.dataset_id,
+        deduplicated.content,
+        1 - deduplicated.distance AS similarity
+    FROM
+        deduplicated
+    ORDER BY
+        deduplicated.distance
+    LIMIT p_limit;
+END;
+$$;
+
+ALTER FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) OWNER TO "postgres";
+
+GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "anon";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "authenticated";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "service_role";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "anon";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "authenticated";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "service_role";
@@ -0,0 +1,16 @@
+-- Chunks stored so far by the ingestion of a document, an interrupted ingestion resumes after them
+ALTER TABLE "public"."documents" ADD COLUMN IF NOT EXISTS "chunk_count" bigint DEFAULT 0 NOT NULL;
+
+UPDATE "public"."documents" "d" SET "chunk_count" = (SELECT count(*) FROM "public"."chunks" "c" WHERE "c"."document_id" = "d"."id");
+
+-- Chunks are upserted by (document_id, chunk_index), keep one row of each before enforcing it
+DELETE FROM "public"."chunks" "c"
+ USING "public"."chunks" "newer"
+ WHERE "c"."document_id" = "newer"."document_id"
+   AND "c"."chunk_index" = "newer"."chunk_index"
+   AND "c"."id" < "newer"."id";
+
+CREATE UNIQUE INDEX IF NOT EXISTS "chunks_document_id_chunk_index_idx" ON "public"."chunks" USING "btree" ("document_id", "chunk_index");
+
+-- Covered by the unique index
+DROP INDEX IF EXISTS "public"."chunks_document_id_idx";
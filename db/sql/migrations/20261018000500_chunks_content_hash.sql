@@ -0,0 +1,28 @@
+-- Re-ingesting a document only embeds the chunks whose content changed, found by their hash
+ALTER TABLE "public"."chunks" ADD COLUMN IF NOT EXISTS "content_hash" "text";
+
+UPDATE "public"."chunks" SET "content_hash" = encode(sha256(convert_to("content", 'UTF8')), 'hex') WHERE "content_hash" IS NULL;
+
+ALTER TABLE "public"."chunks" ALTER COLUMN "content_hash" SET NOT NULL;
+
+-- Unchanged chunks are moved to their new index and removed ones are disabled, so a document
+-- may have several chunks with the same index while it's re-ingested
+DROP INDEX IF EXISTS "public"."chunks_document_id_chunk_index_idx";
+
+CREATE INDEX IF NOT EXISTS "chunks_document_id_chunk_index_idx" ON "public"."chunks" USING "btree" ("document_id", "chunk_index");
+
+CREATE OR REPLACE FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") RETURNS "void"
+    LANGUAGE "sql"
+    AS $$
+    -- Give unchanged chunks of a re-ingested document their new index, enabling them again if needed
+    UPDATE public.chunks c
+    SET chunk_index = m.chunk_index, enabled = true
+    FROM jsonb_to_recordset(p_moves) AS m(id bigint, chunk_index bigint)
+    WHERE c.id = m.id AND c.document_id = p_document_id;
+$$;
+
+ALTER FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") OWNER TO "postgres";
+
+GRANT ALL ON FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") TO "anon";
+GRANT ALL ON FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") TO "authenticated";
+GRANT ALL ON FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") TO "service_role";
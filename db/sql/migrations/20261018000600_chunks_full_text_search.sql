@@ -0,0 +1,36 @@
+-- Chunks are also searched by full text, fused with the vector search by the API.
+-- Adding the stored column rewrites the table, run it when the load is low.
+ALTER TABLE "public"."chunks" ADD COLUMN IF NOT EXISTS "content_tsv" "tsvector" GENERATED ALWAYS AS ("to_tsvector"('"english"'::"regconfig", "content")) STORED;
+
+CREATE INDEX IF NOT EXISTS "chunks_content_tsv_idx" ON "public"."chunks" USING "gin" ("content_tsv");
+
+CREATE OR REPLACE FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) RETURNS TABLE("id" bigint, "document_id" bigint, "dataset_id" bigint, "content" "text", "rank" real)
+    LANGUAGE "sql" STABLE
+    AS $$
+    -- Full-text search of the chunks, with the query in web search syntax ("quoted phrase", or, -word)
+    SELECT
+        c.id,
+        c.document_id,
+        d.dataset_id,
+        c.content,
+        ts_rank_cd(c.content_tsv, q) AS rank
+    FROM
+        public.chunks c
+        JOIN public.documents d ON c.document_id = d.id,
+        websearch_to_tsquery('english', p_query) q
+    WHERE
+        c.content_tsv @@ q
+        AND d.dataset_id = ANY(p_dataset_ids)
+        AND c.enabled
+        AND d.enabled
+    ORDER BY
+        rank DESC,
+        c.id
+    LIMIT p_limit;
+$$;
+
+ALTER FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) OWNER TO "postgres";
+
+GRANT ALL ON FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) TO "anon";
+GRANT ALL ON FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) TO "authenticated";
+GRANT ALL ON FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) TO "service_role";
@@ -26,28 +26,139 @@ $$;
 
 ALTER FUNCTION "public"."get_user_by_id"("user_id" "uuid") OWNER TO "postgres";
 
-CREATE OR REPLACE FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer) RETURNS TABLE("id" bigint, "document_id" bigint, "content" "text", "embedding" "public"."vector", "similarity" double precision)
+CREATE OR REPLACE FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") RETURNS "void"
+    LANGUAGE "sql"
+    AS $$
+    -- Give unchanged chunks of a re-ingested document their new index, enabling them again if needed
+    UPDATE public.chunks c
+    SET chunk_index = m.chunk_index, enabled = true
+    FROM jsonb_to_recordset(p_moves) AS m(id bigint, chunk_index bigint)
+    WHERE c.id = m.id AND c.document_id = p_document_id;
+$$;
+
+ALTER FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") OWNER TO "postgres";
+
+CREATE OR REPLACE FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer DEFAULT 40) RETURNS TABLE("id" bigint, "document_id" bigint, "content" "text", "embedding" "public"."vector", "similarity" double precision)
+    LANGUAGE "plpgsql"
+    AS $$
+BEGIN
+    -- Candidates visited by the HNSW index, the higher the better the recall and the slower
+    PERFORM set_config('hnsw.ef_search', LEAST(GREATEST(p_ef_search, p_limit), 1000)::text, true);
+    -- Keep scanning the index until enough chunks pass the filters. Only pgvector 0.8 and
+    -- later have this setting, older versions may return fewer chunks than asked for.
+    IF (SELECT string_to_array(extversion, '.')::int[] >= ARRAY[0, 8] FROM pg_extension WHERE extname = 'vector') THEN
+        PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    END IF;
+
+    RETURN QUERY
+    WITH nearest AS MATERIALIZED (
+        SELECT
+            c.id,
+            c.document_id,
+            c.content,
+            c.embedding,
+            c.embedding <=> p_query_vector AS distance
+        FROM
+            chunks_with_dataset c
+        WHERE
+            c.dataset_id = p_dataset_id
+            AND c.enabled
+            AND c.document_enabled
+        ORDER BY
+            c.embedding <=> p_query_vector
+        LIMIT p_limit
+    )
+    SELECT
+        nearest.id,
+        nearest.document_id,
+        nearest.content,
+        nearest.embedding,
+        1 - nearest.distance AS similarity
+    FROM
+        nearest
+    -- The iterative scan may return chunks slightly out of order
+    ORDER BY
+        nearest.distance;
+END;
+$$;
+
+ALTER FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) OWNER TO "postgres";
+
+CREATE OR REPLACE FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer DEFAULT 40) RETURNS TABLE("id" bigint, "document_id" bigint, "dataset_id" bigint, "content" "text", "similarity" double precision)
     LANGUAGE "plpgsql"
     AS $$
 BEGIN
+    PERFORM set_config('hnsw.ef_search', LEAST(GREATEST(p_ef_search, p_limit * 4), 1000)::text, true);
+    IF (SELECT string_to_array(extversion, '.')::int[] >= ARRAY[0, 8] FROM pg_extension WHERE extname = 'vector') THEN
+        PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    END IF;
+
     RETURN QUERY
-    SELECT 
+    WITH candidates AS MATERIALIZED (
+        -- Oversample, so there are enough chunks left once duplicates are dropped
+        SELECT
+            c.id,
+            c.document_id,
+            c.dataset_id,
+            c.content,
+            c.embedding <=> p_query_vector AS distance
+        FROM
+            chunks_with_dataset c
+        WHERE
+            c.dataset_id = ANY(p_dataset_ids)
+            AND c.enabled
+            AND c.document_enabled
+        ORDER BY
+            c.embedding <=> p_query_vector
+        LIMIT p_limit * 4
+    ), deduplicated AS (
+        -- The same content may be indexed in several datasets, keep its closest chunk
+        SELECT DISTINCT ON (md5(candidates.content)) *
+        FROM candidates
+        ORDER BY md5(candidates.content), candidates.distance
+    )
+    SELECT
+        deduplicated.id,
+        deduplicated.document_id,
+        deduplicated.dataset_id,
+        deduplicated.content,
+        1 - deduplicated.distance AS similarity
+    FROM
+        deduplicated
+    ORDER BY
+        deduplicated.distance
+    LIMIT p_limit;
+END;
+$$;
+
+ALTER FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) OWNER TO "postgres";
+
+CREATE OR REPLACE FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) RETURNS TABLE("id" bigint, "document_id" bigint, "dataset_id" bigint, "content" "text", "rank" real)
+    LANGUAGE "sql" STABLE
+    AS $$
+    -- Full-text search of the chunks, with the query in web search syntax ("quoted phrase", or, -word)
+    SELECT
         c.id,
         c.document_id,
+        d.dataset_id,
         c.content,
-        c.embedding,
-        1 - (c.embedding <=> p_query_vector) AS similarity
-    FROM 
-        chunks_with_dataset c
-    WHERE 
-        c.dataset_id = p_dataset_id
-    ORDER BY 
-        c.embedding <=> p_query_vector
+        ts_rank_cd(c.content_tsv, q) AS rank
+    FROM
+        public.chunks c
+        JOIN public.documents d ON c.document_id = d.id,
+        websearch_to_tsquery('english', p_query) q
+    WHERE
+        c.content_tsv @@ q
+        AND d.dataset_id = ANY(p_dataset_ids)
+        AND c.enabled
+        AND d.enabled
+    ORDER BY
+        rank DESC,
+        c.id
     LIMIT p_limit;
-END;
 $$;
 
-ALTER FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer) OWNER TO "postgres";
+ALTER FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) OWNER TO "postgres";
 
 SET default_tablespace = '';
 
@@ -108,7 +219,7 @@ CREATE TABLE IF NOT EXISTS "public"."chats" (
     "user_id" "uuid" NOT NULL,
     "from_type" "text" NOT NULL,
     "name" "text",
-    "updated_at" timestamp with time zone DEFAULT "now"(),
+    "updated_at" timestamp with time zone DEFAULT "now"() NOT NULL,
     "status" "text"
 );
 
@@ -139,11 +250,13 @@ CREATE TABLE IF NOT EXISTS "public"."chunks" (
     "id" bigint NOT NULL,
     "created_at" timestamp with time zone DEFAULT "now"() NOT NULL,
     "content" "text" NOT NULL,
-    "embedding" "public"."vector" NOT NULL,
+    "embedding" "public"."vector"(384) NOT NULL,
     "document_id" bigint,
     "chunk_index" bigint,
     "user_id" "uuid",
-    "enabled" boolean DEFAULT true
+    "enabled" boolean DEFAULT true NOT NULL,
+    "content_hash" "text" NOT NULL,
+    "content_tsv" "tsvector" GENERATED ALWAYS AS ("to_tsvector"('"english"'::"regconfig", "content")) STORED
 );
 
 ALTER TABLE "public"."chunks" OWNER TO "postgres";
@@ -159,7 +272,8 @@ CREATE TABLE IF NOT EXISTS "public"."documents" (
     "name" "text",
     "path" "text",
     "updated_at" timestamp with time zone DEFAULT "now"(),
-    "enabled" boolean DEFAULT true
+    "enabled" boolean DEFAULT true NOT NULL,
+    "chunk_count" bigint DEFAULT 0 NOT NULL
 );
 
 ALTER TABLE "public"."documents" OWNER TO "postgres";
@@ -173,7 +287,9 @@ CREATE OR REPLACE VIEW "public"."chunks_with_dataset" AS
     "c"."embedding",
     "c"."document_id",
     "c"."chunk_index",
-    "d"."dataset_id"
+    "d"."dataset_id",
+    "c"."enabled",
+    "d"."enabled" AS "document_enabled"
    FROM ("public"."chunks" "c"
      JOIN "public"."documents" "d" ON (("c"."document_id" = "d"."id")));
 
@@ -296,7 +412,7 @@ CREATE TABLE IF NOT EXISTS "public"."tools" (
     "created_at" timestamp with time zone DEFAULT "now"() NOT NULL,
     "user_id" "uuid",
     "variables" "jsonb" DEFAULT '{}'::"jsonb",
-    "updated_at" timestamp with time zone DEFAULT "now"(),
+    "updated_at" timestamp with time zone DEFAULT "now"() NOT NULL,
     "is_public" boolean DEFAULT false
 );
 
@@ -388,6 +504,24 @@ ALTER TABLE ONLY "public"."user_settings"
 ALTER TABLE ONLY "public"."user_settings"
     ADD CONSTRAINT "users_user_id_key" UNIQUE ("user_id");
 
+CREATE INDEX "chunks_document_id_chunk_index_idx" ON "public"."chunks" USING "btree" ("document_id", "chunk_index");
+
+CREATE INDEX "chunks_content_tsv_idx" ON "public"."chunks" USING "gin" ("content_tsv");
+
+CREATE INDEX "chunks_embedding_hnsw_idx" ON "public"."chunks" USING "hnsw" ("embedding" "public"."vector_cosine_ops") WITH ("m"='16', "ef_construction"='64');
+
+CREATE INDEX "documents_dataset_id_idx" ON "public"."documents" USING "btree" ("dataset_id");
+
+CREATE INDEX "chat_messages_chat_id_id_idx" ON "public"."chat_messages" USING "btree" ("chat_id", "id");
+
+CREATE INDEX "chats_user_id_updated_at_idx" ON "public"."chats" USING "btree" ("user_id", "updated_at" DESC, "id" DESC);
+
+CREATE INDEX "chats_user_id_created_at_idx" ON "public"."chats" USING "btree" ("user_id", "created_at" DESC, "id" DESC);
+
+CREATE INDEX "tools_user_id_updated_at_idx" ON "public"."tools" USING "btree" ("user_id", "updated_at" DESC, "id" DESC);
+
+CREATE INDEX "tools_public_updated_at_idx" ON "public"."tools" USING "btree" ("updated_at" DESC, "id" DESC) WHERE "is_public";
+
 ALTER TABLE ONLY "public"."api_keys"
     ADD CONSTRAINT "api_keys_user_id_fkey" FOREIGN KEY ("user_id") REFERENCES "auth"."users"("id");
 
@@ -497,9 +631,21 @@ GRANT ALL ON FUNCTION "public"."get_user_by_id"("user_id" "uuid") TO "anon";
 GRANT ALL ON FUNCTION "public"."get_user_by_id"("user_id" "uuid") TO "authenticated";
 GRANT ALL ON FUNCTION "public"."get_user_by_id"("user_id" "uuid") TO "service_role";
 
-GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer) TO "anon";
-GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer) TO "authenticated";
-GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer) TO "service_role";
+GRANT ALL ON FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") TO "anon";
+GRANT ALL ON FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") TO "authenticated";
+GRANT ALL ON FUNCTION "public"."move_chunks"("p_document_id" bigint, "p_moves" "jsonb") TO "service_role";
+
+GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "anon";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "authenticated";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_dataset"("p_dataset_id" integer, "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "service_role";
+
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "anon";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "authenticated";
+GRANT ALL ON FUNCTION "public"."search_chunks_by_datasets"("p_dataset_ids" bigint[], "p_query_vector" "public"."vector", "p_limit" integer, "p_ef_search" integer) TO "service_role";
+
+GRANT ALL ON FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) TO "anon";
+GRANT ALL ON FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) TO "authenticated";
+GRANT ALL ON FUNCTION "public"."search_chunks_lexical"("p_dataset_ids" bigint[], "p_query" "text", "p_limit" integer) TO "service_role";
 
 GRANT ALL ON TABLE "public"."api_keys" TO "anon";
 GRANT ALL ON TABLE "public"."api_keys" TO "authenticated";